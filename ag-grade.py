@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 import autograder, canvas
 import subprocess
-import shutil, os, stat, sys, re
+import shutil, os, stat, sys, re, argparse
 
 if sys.hexversion < 0x030000F0:
     print("This script requires Python 3")
@@ -9,7 +9,7 @@ if sys.hexversion < 0x030000F0:
 
 
 def compile_warning_errors(ag):
-    (didRun, tooSlow, retcode, stdoutdata, stderrdata) = ag.run(['make'])
+    (didRun, tooSlow, retcode, stdoutdata, stderrdata) = ag.run(['make'], cache=True)
 
     for line in stderrdata.split('\n'):
         if " warning: " in line:
@@ -53,27 +53,40 @@ config = autograder.config()
 settings = config.get()
 subdirName = settings['subdirName']
 
+parser = argparse.ArgumentParser(description="Autograde submissions.")
+parser.add_argument("-j", "--jobs", type=int, default=1, help="number of submissions to grade at the same time (default: 1)")
+parser.add_argument("dirs", nargs="*", help="submissions to grade (default: all submissions)")
+args = parser.parse_args()
+
 
 # Get a list of subdirectories (each student submission will be in its own subdirectory)
 dirs = [name for name in os.listdir(subdirName) if os.path.isdir(os.path.join(subdirName, name))]
 dirs.sort()
+# Record which version of this script graded each submission (see "ag.py regrade --stale").
+autograder.gradingFiles = config.gradingFiles()
+# Reuse the results of "make" when a submission is graded again.
+autograder.buildCacheDir = os.path.abspath("autograder-cache")
+# Don't read reference files checked with expect_md5() again if they haven't changed.
+autograder.hashCacheFile = os.path.abspath("autograder-hashes.json")
+# Measure the speed of reference solutions for autograder.benchmark() only once.
+autograder.benchmarkCacheFile = os.path.abspath("autograder-benchmarks.json")
+# Run reference solutions (autograder.reference()) once per input, not once per submission.
+autograder.referenceCacheDir = os.path.abspath("autograder-reference")
 os.chdir(subdirName)
 
-if len(sys.argv) > 1:
-    dirs = sys.argv[1:]
+if len(args.dirs) > 0:
+    dirs = args.dirs
 
 
-# For each subdirectory (i.e., student)
-for thisDir in dirs:
+# Grade one subdirectory (i.e., student)
+def grade(thisDir):
 
+    # Set up the autograder
     ag = autograder.autograder(thisDir)
     if ag.isGraded():
         print("SKIPPING %s because it has already been autograded." % thisDir)
         ag.skip()
-        continue
-
-    # Set up the autograder
-    ag = autograder.autograder("AUTOGRADE.txt", thisDir)
+        return
 
     # Verify that the files are there that we are expecting and look for unexpected files.
     ag.expect_only_files(["makefile", "Makefile", "*.c", "*.cpp", "*.h", "README", "README.txt"], 1)
@@ -86,7 +99,7 @@ for thisDir in dirs:
     for f in exe:
         ag.delete(f)
     # run 'make' in the students directory
-    ag.run_expectExitCode(["make"], expectExitCode=0, deductWrongExit=5, timeout=30)
+    ag.run_expectExitCode(["make"], expectExitCode=0, deductWrongExit=5, timeout=30, cache=True)
     ag.expect_file_all_of(exe, 5) # check that exe got created
 
     # Figure out if all executables are there.
@@ -103,7 +116,7 @@ for thisDir in dirs:
         # to that one!
         ag.log_addEntry("Can't find expected executables. Giving up.", 50)
         ag.cleanup()
-        continue
+        return
 
     # Check if the executables contain debugging information in them:
     for e in exe:
@@ -112,8 +125,7 @@ for thisDir in dirs:
     ag.log_addEntry("=== Check that Makefile contains appropriate things. ===")
     mf = ag.find_first_matching_file(["makefile", "Makefile"])
     if mf:
-        ag.file_must_contain(mf, "-Wall", 5)
-        ag.file_must_contain(mf, "-std=c99", 5)
+        ag.file_must_contain(mf, [ ("-Wall", 5), ("-std=c99", 5) ])
 
     # Run "make clean" and verify that files are erased
     ag.log_addEntry("=== Check that 'make clean' works. ===")
@@ -127,7 +139,7 @@ for thisDir in dirs:
 
     ag.log_addEntry("=== Try running with incorrect arguments. ====")
     ag.pristine() # Reset the directory back to exactly as the student submitted it.
-    ag.run(['make'], quiet=True, timeout=30)
+    ag.run(['make'], quiet=True, timeout=30, cache=True)
     ag.run_expectNotExitCode(['./mtusort' ], stdindata=None, expectNotExitCode=0, deductTimeout=5, deductSegfault=5, deductWrongExit=1, timeout=5)
     ag.run_expectNotExitCode(['./mtusort', 'foobar'], stdindata=None, expectNotExitCode=0, deductTimeout=5, deductSegfault=5, deductWrongExit=1, timeout=30)
     ag.run_expectNotExitCode(['./mtusort', '/does/not/exist.in', '/does/not/exist.out'], stdindata=None, expectNotExitCode=0, deductTimeout=5, deductSegfault=5, deductWrongExit=1, timeout=30)
@@ -136,3 +148,6 @@ for thisDir in dirs:
 
 
     ag.cleanup()
+
+
+autograder.gradeAll(dirs, grade, jobs=args.jobs)
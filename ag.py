@@ -42,13 +42,18 @@ if len(sys.argv) < 2:
     print("     Lock or unlock submissions so subsequent downloads won't overwrite the submissions for one or more students.")
 
     print()
-    print(" regrade [usernames...]")
+    print(" regrade [--stale] [usernames...]")
     print("     Erase all AUTOGRADE.html files to force complete regrading. Useful when the ag-grade.py script is changed by the instructor.")
+    print("     With --stale, only erase reports for submissions that changed or that were graded by a different version of ag-grade.py, autograder.py or the supportFiles in autograde-config.json.")
 
     print()
     print(" view username")
     print("     View autograder report via command line.")
 
+    print()
+    print(" text username")
+    print("     Print the autograder report as plain text (from AUTOGRADE.results.json).")
+
     print()
     print(" viewgui username")
     print("     View autograder report via web browser.")
@@ -68,6 +73,10 @@ emailFromName = settings['emailFromName']
 emailPassword = settings['emailPassword']
 emailSmtp     = settings['emailSmtp']
 emailSmtpPort = settings['emailSmtpPort']
+autograder.gradingFiles = config.gradingFiles()
+# Use the same file hashes as ag-grade.py so that finding stale
+# reports doesn't read every submission again.
+autograder.hashCacheFile = os.path.abspath("autograder-hashes.json")
 
 
 def changeLock(dirs, lock):
@@ -84,7 +93,35 @@ def unlock(dirs):
     changeLock(dirs, 0)
 def lock(dirs):
     changeLock(dirs, 1)
-def regrade(dirs):
+def isStale(thisDir):
+    """Returns a reason why the report for thisDir is out of date or None if it is current."""
+    metadataFile = os.path.join(thisDir, "AUTOGRADE.json")
+    if not os.path.exists(metadataFile) or not os.path.exists(os.path.join(thisDir, "AUTOGRADE.html")):
+        return "not graded"
+    with open(metadataFile, "r") as f:
+        metadata = json.load(f)
+    old = metadata.get('autograderFingerprint')
+    if old is None:
+        return "graded before fingerprints were recorded"
+    new = autograder.fingerprint(thisDir)
+    if old.get('grading') != new['grading']:
+        return "grading script changed"
+    if old.get('submission') != new['submission']:
+        return "submission changed"
+    return None
+
+def regrade(dirs, stale=False):
+    if stale:
+        staleDirs = []
+        for thisDir in dirs:
+            reason = isStale(thisDir)
+            if reason is not None:
+                print("%s: %s" % (thisDir, reason))
+                staleDirs.append(thisDir)
+        autograder.hashCache.save()
+        print("%d of %d submissions need to be regraded." % (len(staleDirs), len(dirs)))
+        dirs = staleDirs
+
     for thisDir in dirs:
         agfile = os.path.join(thisDir, "AUTOGRADE.html")
         if os.path.exists(agfile):
@@ -121,9 +158,25 @@ def emailSent(dirs):
 
 
 
+def runUsage(metadata):
+    """Returns the total CPU time (seconds) and largest peak memory usage (bytes) of the programs the autograder ran for a submission. Either value is None if the autograder did not record this information."""
+    runs = [ r for r in metadata.get('autograderRuns', []) if r.get('usage') ]
+    if len(runs) == 0:
+        return (None, None)
+    # Prefer the numbers for the whole process tree when commands ran
+    # in a cgroup.
+    cpu = sum([ r['usage'].get('cgroupCpuTime', r['usage']['userTime'] + r['usage']['systemTime']) for r in runs ])
+    # maxRss from wait4() includes the memory of the autograder that
+    # forked the command, so it says nothing about the submission.
+    # Only the cgroup's memory.peak is usable here.
+    peaks = [ r['usage']['cgroupMemoryPeak'] for r in runs if 'cgroupMemoryPeak' in r['usage'] ]
+    rss = max(peaks) if len(peaks) == len(runs) else None
+    return (cpu, rss)
+
 def stats(dirs):
     score_list=[]
-    print("%-12s %5s %9s %9s %5s %4s %4s %5s %s" % ("name", "agPts", "agPtsOrig", "canvasPts", "atmpt", "late", "lock", "email", "SubmitTime"))
+    usage_list=[]
+    print("%-12s %5s %9s %9s %5s %4s %4s %5s %7s %7s %s" % ("name", "agPts", "agPtsOrig", "canvasPts", "atmpt", "late", "lock", "email", "cpuSec", "peakMem", "SubmitTime"))
     for d in dirs:
         metadataFile = d + "/AUTOGRADE.json"
         metadata = {}
@@ -177,10 +230,31 @@ def stats(dirs):
                 utc_dt = utc_dt.replace(tzinfo=datetime.timezone.utc)
                 timeString = canvas.canvas.prettyDate(utc_dt, datetime.datetime.now(tz=datetime.timezone.utc))
 
-        print("%-12s %5s %9s %9s %5d %4s %4s %5s %s" % (d, score, scoreOrig, canvasScore, attempt, late, locked, emailed, timeString))
+        cpuString="    ---"
+        rssString="    ---"
+        (cpu, rss) = runUsage(metadata)
+        if cpu is not None:
+            cpuString = "%7.2f" % cpu
+            if rss is not None:
+                rssString = "%6dM" % (rss/1024/1024)
+            usage_list.append((d, cpu, rss))
+
+        print("%-12s %5s %9s %9s %5d %4s %4s %5s %7s %7s %s" % (d, score, scoreOrig, canvasScore, attempt, late, locked, emailed, cpuString, rssString, timeString))
 
     print("Submissions shown: %d" % len(dirs))
 
+    # Show the submissions that used the most resources while being
+    # autograded.
+    if len(usage_list) > 0:
+        usage_list.sort(key=lambda u: u[1], reverse=True)
+        print("Most CPU time: " + ", ".join([ "%s (%.2fsec)" % (u[0], u[1]) for u in usage_list[:3] ]))
+        memory_list = [ u for u in usage_list if u[2] is not None ]
+        if len(memory_list) > 0:
+            memory_list.sort(key=lambda u: u[2], reverse=True)
+            print("Most memory:   " + ", ".join([ "%s (%dM)" % (u[0], u[2]/1024/1024) for u in memory_list[:3] ]))
+        else:
+            print("Most memory:   unknown (commands did not run in a cgroup)")
+
     average = "?"
     media = "?"
     try:
@@ -396,10 +470,12 @@ elif sys.argv[1] == "unlock":
         unlock(dirs)
 elif sys.argv[1] == 'regrade':
     os.chdir(subdirName)
-    if len(sys.argv) > 2:
-        regrade(sys.argv[2:])
+    stale = "--stale" in sys.argv[2:]
+    args = [ a for a in sys.argv[2:] if a != "--stale" ]
+    if len(args) > 0:
+        regrade(args, stale)
     else:
-        regrade(dirs)
+        regrade(dirs, stale)
 elif sys.argv[1] == 'emailClearCache':
     os.chdir(subdirName)
     if len(sys.argv) > 2:
@@ -479,6 +555,20 @@ elif sys.argv[1] == 'view':
         print(" ag.py view username")
         exit(1)
 
+elif sys.argv[1] == 'text':
+    if len(sys.argv) == 3:
+        path = os.path.join(subdirName, sys.argv[2], "AUTOGRADE.results.json")
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                results = json.load(f)
+            print(autograder.renderText(results['records']), end="")
+        else:
+            print("Can't view file: %s"%path)
+    else:
+        print("Usage:")
+        print(" ag.py text username")
+        exit(1)
+
 elif sys.argv[1] == 'viewgui':
     if len(sys.argv) == 3:
         path = os.path.join(subdirName, sys.argv[2], "AUTOGRADE.html")
@@ -1,6 +1,16 @@
+import asyncio
+import codecs
+import collections
+import contextvars
+import difflib
+import functools
+import errno
+import fcntl
+import gzip
 import hashlib
 import os
-import subprocess, threading
+import sys
+import subprocess, threading, selectors
 import shutil
 import glob
 import stat
@@ -8,11 +18,16 @@ import string
 import signal
 import time,datetime
 import json
+import platform
 import tempfile
 import cgi
 import html
 import resource
 import re
+import math
+import statistics
+import mmap
+import itertools
 
 # Set to True if you wish to run the autograder scripts as root, but
 # then have the script automatically switch to a different user
@@ -27,6 +42,138 @@ normalGid=1000
 # The id of the user that the submissions should be run as.
 autograderUid=1001
 
+# When several submissions are graded at the same time (see
+# gradeAll()), each worker process runs submitted code as a different
+# user so that the killall and process group cleanup done by one
+# worker can't reach the processes of another worker. List at least
+# as many user ids here as the number of jobs you run in parallel.
+autograderWorkerUids=[autograderUid]
+
+# Set useCgroups to True to run each command in its own cgroup
+# (version 2) below cgroupRoot. The cgroup limits the memory, number
+# of processes and CPU of the whole process tree, lets us kill every
+# process that the command started (including ones that called
+# setsid()) and measures the CPU time and peak memory of all of
+# them. Requires running as root on a kernel with cgroup.kill (5.14+).
+useCgroups=False
+cgroupRoot="/sys/fs/cgroup/autograder"
+# Written to cpu.max of each cgroup. "max" is no limit; "100000 100000"
+# allows the command to use one CPU.
+cgroupCpuMax="max"
+
+# Helper programs (from util-linux) that switch users and set resource
+# limits for submitted programs. Using them lets subprocess.Popen()
+# start programs with vfork() instead of fork()ing a copy of the whole
+# autograder to run Python code (preexec_fn) before exec(). If they
+# are missing, we fall back to Command.setProcessLimits().
+setprivPath="/usr/bin/setpriv"
+prlimitPath="/usr/bin/prlimit"
+
+# When a program runs too long, it is sent SIGINT (Ctrl+C) and gets
+# up to terminateGrace seconds to clean up (for example, valgrind
+# printing its final summary) before it is killed.
+terminateGrace=.3
+
+# stdout and stderr of each program are kept in memory. Output up to
+# captureLimitBytes long is kept completely. For longer output, only
+# the first captureHeadBytes and the last captureTailBytes are kept.
+captureLimitBytes=10000
+captureHeadBytes=4000
+captureTailBytes=4000
+# If set, the report shows at most the first captureHeadLines and the
+# last captureTailLines lines of the output (within the byte limits
+# above). The capture argument of autograder.run() and Command sets
+# these limits for a single program, e.g.,
+# capture={ 'headLines': 20, 'tailLines': 5 }.
+captureHeadLines=None
+captureTailLines=None
+
+# If output is left out of the report, the complete output can be
+# saved in a compressed file that the report links to:
+# "gzip", "zstd" (requires the zstandard module) or None. The files
+# are kept in an AUTOGRADE.output directory next to AUTOGRADE.html and
+# at most outputArtifactLimitBytes (before compression) of each
+# program's stdout and stderr are saved.
+outputArtifacts=None
+outputArtifactLimitBytes=256*1024*1024
+
+# The autograder report is built in memory and written to disk when
+# grading finishes. So that a partial report is available if the
+# autograder crashes or hangs, it is also written out when more than
+# logFlushSeconds have passed since it was last written (None = only
+# at the end).
+logFlushSeconds=5
+
+# Directory where the files created by build commands (see the cache
+# argument of autograder.run()) are saved. If the same command runs
+# again on identical files with the same tools, the saved files are
+# copied into the working directory and the saved output is reused
+# instead of running the command again. None disables the cache.
+buildCacheDir=None
+# Programs that are part of the build cache key: if any of them
+# changes (e.g., the compiler is upgraded), nothing is reused.
+buildCacheTools=["make", "cc", "gcc", "g++", "c++", "clang", "clang++", "ld", "as"]
+# Environment variables that are part of the build cache key.
+buildCacheEnv=["PATH", "CC", "CXX", "CFLAGS", "CXXFLAGS", "CPPFLAGS", "LDFLAGS", "LDLIBS"]
+
+# Files besides the submission and autograder.py that decide the
+# grade (e.g., the grading script and input files it uses). A hash of
+# them is saved in AUTOGRADE.json (see fingerprint()) so that
+# "ag.py regrade --stale" can find reports made by an older version of
+# the grading script. ag-grade.py sets this with config.gradingFiles().
+gradingFiles=[]
+
+# pristine() copies each submitted file into the working directory
+# with a reflink (FICLONE) when the file system supports it (btrfs,
+# xfs), so the data is shared until someone writes to it. If
+# pristineHardlinks is True, files that the autograder user can read
+# but can't modify are hard linked instead (also on file systems
+# without reflinks). They then keep their original owner and
+# permissions, so submitted programs can't change them---only enable
+# this if your grading script doesn't expect to be able to write to
+# submitted files.
+pristineHardlinks=False
+
+# Set scratchDir to a memory-backed directory (e.g., "/dev/shm" or a
+# dedicated tmpfs mount) to keep the working directory, build outputs
+# and report of each submission in RAM instead of on disk. A
+# submission that is bigger than scratchBudgetBytes, or that grows
+# beyond it while it is graded, is moved to the normal temporary
+# directory. Hard links (pristineHardlinks) don't work across file
+# systems, so files are copied into scratchDir.
+#
+# The budget is only checked between commands, so each submission
+# gets its own tmpfs of scratchLimitBytes mounted in scratchDir
+# (requires root; submissions start on disk if the mount fails). A
+# command that writes more than that runs out of space, so make it
+# larger than anything a correct submission writes at once.
+scratchDir=None
+scratchBudgetBytes=64*1024*1024
+scratchLimitBytes=1024*1024*1024
+
+# File where the hashes computed by fileHash() (e.g., by expect_md5()
+# and when fingerprinting submissions) are saved between runs. A file
+# whose device, inode, size, modification time and inode change time
+# are the same as when it was hashed isn't read again. None keeps the
+# hashes only while the autograder runs. ag-grade.py sets this to a
+# file in the assignment directory.
+hashCacheFile=None
+
+# File where autograder.benchmark() saves how fast the reference
+# solution is on each input, so that it is only measured once on each
+# machine (and again when the reference solution changes). None
+# measures it again in each autograder process. ag-grade.py sets this
+# to a file in the assignment directory.
+benchmarkCacheFile=None
+
+# Directory where autograder.reference() saves the output (stdout,
+# stderr, exit code and created files) of a reference solution for
+# each input. The reference solution then runs once per input instead
+# of once per submission, and again only when it changes. None runs it
+# for every submission. ag-grade.py sets this to a directory in the
+# assignment directory.
+referenceCacheDir=None
+
 
 class bcolors:
     FAIL = '\033[91m\033[1m'  # red, bold
@@ -62,22 +209,1240 @@ class config():
             # add trailing newline
             f.write('\n')
 
+    def gradingFiles(self):
+        """Returns absolute paths to the grading script (the "gradingScript" setting, default ag-grade.py) and the files matching the globs in the "supportFiles" setting. Paths in the settings are relative to the directory of the config file."""
+        baseDir = os.path.dirname(self.configfile)
+        files = [ os.path.join(baseDir, self.settings.get('gradingScript', 'ag-grade.py')) ]
+        for pattern in self.settings.get('supportFiles', []):
+            files += sorted(glob.glob(os.path.join(baseDir, pattern), recursive=True))
+        return files
+
+
+def _gradeAllWorker(todo, gradeFunc, uid):
+    """Worker process for gradeAll(): grades submissions from the todo queue as user uid."""
+    global autograderUid
+    autograderUid = uid
+    while True:
+        thisDir = todo.get()
+        if thisDir is None:
+            return
+        gradeFunc(thisDir)
+
+def gradeAll(dirs, gradeFunc, jobs=1):
+    """Calls gradeFunc(dir) for each submission directory in dirs. If jobs is larger than 1, that many submissions are graded at the same time in separate worker processes. Each worker runs submitted code as its own user from autograderWorkerUids and each autograder object has its own temporary directory and log, so the reports are the same as the ones produced by grading one submission at a time."""
+    if jobs <= 1:
+        for thisDir in dirs:
+            gradeFunc(thisDir)
+        return
+
+    if switchUser and len(autograderWorkerUids) < jobs:
+        print("Grading %d submissions at a time requires at least %d user ids in autograderWorkerUids." % (jobs, jobs))
+        exit(1)
+
+    # Workers inherit gradeFunc and the current working directory
+    # from this process, so we must fork() them.
+    import multiprocessing
+    ctx = multiprocessing.get_context("fork")
+    todo = ctx.Queue()
+    for thisDir in dirs:
+        todo.put(thisDir)
+    for i in range(jobs):
+        todo.put(None)  # tells a worker to exit
+
+    workers = []
+    for i in range(jobs):
+        uid = autograderWorkerUids[i % len(autograderWorkerUids)]
+        worker = ctx.Process(target=_gradeAllWorker, args=(todo, gradeFunc, uid))
+        worker.start()
+        workers.append(worker)
+
+    failed = 0
+    for worker in workers:
+        worker.join()
+        if worker.exitcode != 0:
+            failed += 1
+    if failed > 0:
+        print(bcolors.FAIL + "%d grading worker(s) exited with an error. Some submissions may not have been graded." % failed + bcolors.ENDC)
+
+
+def findUserProcesses(uid):
+    """Returns the process ids of all running (i.e., not zombie) processes owned by uid."""
+    pids = []
+    with os.scandir("/proc") as entries:
+        for entry in entries:
+            if entry.name.isdigit():
+                try:
+                    if entry.stat().st_uid == uid:
+                        with open(os.path.join(entry.path, "stat"), "r") as f:
+                            # The state follows the command name, which is in parentheses.
+                            state = f.read().rsplit(")", 1)[1].split()[0]
+                        if state != "Z":
+                            pids.append(int(entry.name))
+                except (FileNotFoundError, ProcessLookupError):
+                    pass  # process exited
+    return pids
+
+def killUserProcesses(uid):
+    """Kills all processes owned by uid (e.g., processes left behind by a previous command). Returns quickly if there are none."""
+    for attempt in range(10):
+        pids = findUserProcesses(uid)
+        if len(pids) == 0:
+            return
+        # Stop everything first so processes can't fork new ones
+        # while we kill them.
+        for sig in [signal.SIGSTOP, signal.SIGKILL]:
+            for pid in pids:
+                try:
+                    os.kill(pid, sig)
+                except ProcessLookupError:
+                    pass
+        time.sleep(.01)
+
+
+class HashCache(object):
+    """Remembers the hashes of files, keyed on their device and inode and valid as long as their size, mtime and ctime don't change."""
+
+    def __init__(self):
+        self.entries = {}
+        self.loaded = None
+        self.dirty = False
+        self.lock = threading.Lock()
+
+    def load(self):
+        """Reads the hashes saved in hashCacheFile (if it changed since it was last read)."""
+        if self.loaded == hashCacheFile:
+            return
+        self.loaded = hashCacheFile
+        if hashCacheFile is None:
+            return
+        try:
+            with open(hashCacheFile, "r") as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return
+        for key, entry in saved.items():
+            self.entries.setdefault(key, entry)
+
+    def hash(self, path, algorithm="md5"):
+        """Returns the hex digest of the file at path using the hashlib algorithm (e.g., "md5" or "sha256"), reading the file only if its hash isn't cached."""
+        # O_NONBLOCK so that opening a FIFO doesn't wait for a writer.
+        fd = os.open(path, os.O_RDONLY|os.O_NONBLOCK)
+        with open(fd, "rb") as f:
+            st = os.fstat(f.fileno())
+            if not stat.S_ISREG(st.st_mode):
+                raise OSError(errno.EINVAL, "Not a regular file", path)
+            key = "%d:%d" % (st.st_dev, st.st_ino)
+            stamp = [ st.st_size, st.st_mtime_ns, st.st_ctime_ns ]
+            with self.lock:
+                self.load()
+                entry = self.entries.get(key)
+                if entry is not None and entry['stamp'] == stamp and algorithm in entry:
+                    return entry[algorithm]
+            if hasattr(hashlib, "file_digest"):
+                digest = hashlib.file_digest(f, algorithm).hexdigest()
+            else:
+                m = hashlib.new(algorithm)
+                for data in iter(lambda: f.read(1024*1024), b""):
+                    m.update(data)
+                digest = m.hexdigest()
+        with self.lock:
+            if entry is None or entry['stamp'] != stamp:
+                entry = { 'stamp': stamp }
+            entry['path'] = os.path.abspath(path)
+            entry[algorithm] = digest
+            self.entries[key] = entry
+            self.dirty = True
+        return digest
+
+    def save(self):
+        """Writes the cached hashes to hashCacheFile, leaving out files that no longer exist (e.g., files in removed working directories)."""
+        if hashCacheFile is None or not self.dirty:
+            return
+        with self.lock:
+            # Another process (e.g., a gradeAll() worker) may have
+            # saved hashes since we loaded the file.
+            self.loaded = None
+            self.load()
+            keep = {}
+            for key, entry in self.entries.items():
+                try:
+                    st = os.stat(entry['path'])
+                except OSError:
+                    continue
+                if "%d:%d" % (st.st_dev, st.st_ino) == key and \
+                   [ st.st_size, st.st_mtime_ns, st.st_ctime_ns ] == entry['stamp']:
+                    keep[key] = entry
+            self.entries = keep
+            tmp = "%s.%d.tmp" % (hashCacheFile, os.getpid())
+            try:
+                with open(tmp, "w") as f:
+                    json.dump(keep, f, separators=(',', ':'))
+                os.replace(tmp, hashCacheFile)
+            except OSError as e:
+                print("Couldn't save file hashes to %s: %s" % (hashCacheFile, e))
+            self.dirty = False
+
+hashCache = HashCache()
+
+def fileHash(path, algorithm="md5"):
+    """Returns the hex digest of the file at path, using hashCache so that a file that hasn't changed is only read once (see hashCacheFile)."""
+    return hashCache.hash(path, algorithm)
+
+
+def treeDigest(directory, h=None, skip=()):
+    """Adds the names, execute permissions and contents of the files (and symlinks) in directory to the hashlib object h (a new sha256 one if None) and returns h. Paths (relative to directory) listed in skip and special files like FIFOs are left out."""
+    if h is None:
+        h = hashlib.sha256()
+    paths = []
+    for path, dirs, filenames in os.walk(directory):
+        dirs[:] = [ d for d in dirs if os.path.relpath(os.path.join(path, d), directory) not in skip ]
+        for f in filenames + [ d for d in dirs if os.path.islink(os.path.join(path, d)) ]:
+            paths.append(os.path.relpath(os.path.join(path, f), directory))
+    for relpath in sorted(paths):
+        if relpath in skip:
+            continue
+        path = os.path.join(directory, relpath)
+        try:
+            st = os.lstat(path)
+            if stat.S_ISLNK(st.st_mode):
+                h.update(("\0link %s %s" % (relpath, os.readlink(path))).encode("utf-8"))
+            elif stat.S_ISREG(st.st_mode):
+                digest = fileHash(path, "sha256")
+                h.update(("\0file %s %o %s" % (relpath, st.st_mode & 0o111, digest)).encode("utf-8"))
+        except OSError:
+            # Removed or replaced (e.g., with a FIFO) by a program that
+            # is still running.
+            h.update(("\0unreadable %s" % relpath).encode("utf-8"))
+    return h
+
+
+# Linux ioctl that makes a file share the data of another one (from linux/fs.h).
+FICLONE = getattr(fcntl, "FICLONE", 0x40049409)
+
+def copyTree(src, dst, uid=None, fileMode=None, dirMode=None, hardlinks=False, symlinks=False, skip=(), skipSymlinks=False):
+    """Copies the directory src to dst (which must not exist) the fastest way the file system allows: a reflink, a hard link (if hardlinks is True and uid can read but not write the file) or copy_file_range() (sendfile() between file systems). If uid is set, the copies are owned by uid and group 0 and get fileMode and dirMode as permissions (otherwise they keep the permissions of the originals). Symlinks are followed unless symlinks is True (copy them as symlinks) or skipSymlinks is True (leave them out). Paths (relative to src) listed in skip aren't copied, and neither are special files like FIFOs."""
+    canReflink = True
+    canCopyRange = True
+    for path, dirs, files in os.walk(src, followlinks=not skipSymlinks):
+        rel = os.path.relpath(path, src)
+        dstDir = os.path.normpath(os.path.join(dst, rel))
+        os.mkdir(dstDir)
+        if uid is not None:
+            os.chown(dstDir, uid, 0)
+        os.chmod(dstDir, dirMode if dirMode is not None else stat.S_IMODE(os.stat(path).st_mode))
+        dirs[:] = [ d for d in dirs if os.path.normpath(os.path.join(rel, d)) not in skip ]
+
+        if skipSymlinks:
+            dirs[:] = [ d for d in dirs if not os.path.islink(os.path.join(path, d)) ]
+        elif symlinks:
+            for d in dirs:
+                if os.path.islink(os.path.join(path, d)):
+                    files.append(d)
+            dirs[:] = [ d for d in dirs if d not in files ]
+
+        for f in files:
+            if os.path.normpath(os.path.join(rel, f)) in skip:
+                continue
+            srcFile = os.path.join(path, f)
+            dstFile = os.path.join(dstDir, f)
+            if skipSymlinks and os.path.islink(srcFile):
+                continue
+            if symlinks and os.path.islink(srcFile):
+                os.symlink(os.readlink(srcFile), dstFile)
+                if uid is not None:
+                    os.lchown(dstFile, uid, 0)
+                continue
+
+            # O_NONBLOCK so that opening a FIFO doesn't wait for a writer.
+            srcFd = os.open(srcFile, os.O_RDONLY|os.O_NONBLOCK|(os.O_NOFOLLOW if skipSymlinks else 0))
+            try:
+                st = os.fstat(srcFd)
+                if not stat.S_ISREG(st.st_mode):
+                    continue
+                # Only link files that uid can read but not change
+                # (programs run as uid with group 0).
+                canRead = st.st_mode & stat.S_IROTH or (st.st_gid == 0 and st.st_mode & stat.S_IRGRP)
+                if hardlinks and uid is not None and st.st_uid != uid and canRead and \
+                   not st.st_mode & (stat.S_IWGRP|stat.S_IWOTH) and not os.path.islink(srcFile):
+                    try:
+                        os.link(srcFile, dstFile)
+                        continue
+                    except OSError:
+                        pass  # e.g., on a different file system
+
+                mode = fileMode if fileMode is not None else stat.S_IMODE(st.st_mode)
+                dstFd = os.open(dstFile, os.O_WRONLY|os.O_CREAT|os.O_EXCL, 0o600)
+                try:
+                    if uid is not None:
+                        os.fchown(dstFd, uid, 0)
+                    os.fchmod(dstFd, mode)
+                    copied = False
+                    if canReflink:
+                        try:
+                            fcntl.ioctl(dstFd, FICLONE, srcFd)
+                            copied = True
+                        except OSError as e:
+                            # Don't try again for the rest of the tree if the
+                            # file system can't do it at all.
+                            if e.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL):
+                                canReflink = False
+                    if not copied:
+                        remaining = st.st_size
+                        while remaining > 0:
+                            n = 0
+                            if canCopyRange:
+                                try:
+                                    n = os.copy_file_range(srcFd, dstFd, remaining)
+                                except OSError:
+                                    # Some kernels can't do this between file systems.
+                                    canCopyRange = False
+                            if not canCopyRange:
+                                n = os.sendfile(dstFd, srcFd, None, remaining)
+                            if n == 0:
+                                break
+                            remaining -= n
+                    # Keep timestamps so make sees the same file ages as in the submission.
+                    os.utime(dstFd, ns=(st.st_atime_ns, st.st_mtime_ns))
+                finally:
+                    os.close(dstFd)
+            finally:
+                os.close(srcFd)
+
+
+def mountScratch(path):
+    """Mounts a tmpfs of scratchLimitBytes on the directory path. Returns False if that isn't possible (e.g., when not running as root)."""
+    if os.geteuid() != 0:
+        return False
+    result = subprocess.run([ "mount", "-t", "tmpfs", "-o", "size=%d,mode=0700" % scratchLimitBytes, "tmpfs", path ],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return result.returncode == 0
+
+
+def unmountScratch(path):
+    """Unmounts the tmpfs that mountScratch() mounted on path (which discards the files in it) and removes path."""
+    # Lazily, in case a leftover process still uses it.
+    subprocess.run([ "umount", "-l", path ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        os.rmdir(path)
+    except OSError:
+        pass
+
+
+def asSandboxUser(function, *args):
+    """Calls function(*args) as autograderUid (in a child process) if switchUser is set, so it can only touch files that the programs being graded could touch themselves. Raises OSError if function raised an exception."""
+    if not switchUser:
+        function(*args)
+        return
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            os.setresuid(autograderUid, autograderUid, autograderUid)
+            function(*args)
+            status = 0
+        except BaseException as e:
+            print("%s: %s" % (function.__name__, e), file=sys.stderr)
+        finally:
+            os._exit(status)
+    (pid, status) = os.waitpid(pid, 0)
+    if os.waitstatus_to_exitcode(status) != 0:
+        raise OSError("%s failed as uid %d" % (function.__name__, autograderUid))
+
+
+def writeFiles(directory, files):
+    """Writes files (filename -> contents, a string or bytes) into directory. Existing files (or symlinks) with those names are replaced rather than written through."""
+    for (filename, contents) in files.items():
+        if isinstance(contents, str):
+            contents = contents.encode("utf-8")
+        path = os.path.join(directory, filename)
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        fd = os.open(path, os.O_WRONLY|os.O_CREAT|os.O_EXCL|os.O_NOFOLLOW, 0o666)
+        with open(fd, "wb") as f:
+            f.write(contents)
+
+
+def makeRunDir(path, files, source=None):
+    """Creates the directory path (a copy of the directory source without its symlinks, if source is set) with files (filename -> contents) in it, replacing anything that is already at path."""
+    if os.path.islink(path):
+        os.unlink(path)
+    elif os.path.exists(path):
+        shutil.rmtree(path)
+    if source is not None:
+        copyTree(source, path, skipSymlinks=True)
+    else:
+        os.mkdir(path)
+    writeFiles(path, files)
+
+
+def openRegularFile(directory, filename):
+    """Opens filename (relative to directory) for reading in binary mode without following symlinks, neither in filename nor directory itself. Returns None if it doesn't exist or isn't a regular file."""
+    try:
+        dirFd = os.open(directory, os.O_RDONLY|os.O_DIRECTORY|os.O_NOFOLLOW)
+    except OSError:
+        return None
+    try:
+        parts = os.path.normpath(filename).split(os.sep)
+        for part in parts[:-1]:
+            fd = os.open(part, os.O_RDONLY|os.O_DIRECTORY|os.O_NOFOLLOW, dir_fd=dirFd)
+            os.close(dirFd)
+            dirFd = fd
+        # O_NONBLOCK so that opening a FIFO doesn't wait for a writer.
+        fd = os.open(parts[-1], os.O_RDONLY|os.O_NOFOLLOW|os.O_NONBLOCK, dir_fd=dirFd)
+    except OSError:
+        return None
+    finally:
+        os.close(dirFd)
+    if not stat.S_ISREG(os.fstat(fd).st_mode):
+        os.close(fd)
+        return None
+    return open(fd, "rb")
+
+
+def dirSize(directory):
+    """Returns the number of bytes of storage used by the files in directory."""
+    total = 0
+    for path, dirs, files in os.walk(directory):
+        for f in files:
+            try:
+                total += os.lstat(os.path.join(path, f)).st_blocks * 512
+            except FileNotFoundError:
+                pass
+    return total
+
+
+def fingerprint(directory):
+    """Returns hashes of what the grade of the submission in directory depends on: 'grading' covers autograder.py and gradingFiles, 'submission' covers the files in directory (except the autograder reports)."""
+    h = hashlib.sha256()
+    for path in [ os.path.abspath(__file__) ] + gradingFiles:
+        h.update(("\0%s " % os.path.basename(path)).encode("utf-8"))
+        if os.path.isdir(path):
+            treeDigest(path, h)
+        elif os.path.exists(path):
+            h.update(fileHash(path, "sha256").encode("utf-8"))
+        else:
+            h.update(b"missing")
+    return { 'grading': h.hexdigest(),
+             'submission': treeDigest(directory, skip=reportFiles).hexdigest() }
+
+
+def robustStats(samples):
+    """Returns the median, minimum, maximum and interquartile range of a list of measurements. Unlike the mean, these aren't thrown off by a few runs that were slowed down by something else on the machine."""
+    (q1, median, q3) = statistics.quantiles(samples, n=4, method="inclusive") if len(samples) > 1 else samples*3
+    return { 'median': median, 'min': min(samples), 'max': max(samples), 'iqr': q3 - q1, 'runs': len(samples) }
+
+
+def machineDescription():
+    """Returns a string that identifies this machine for comparing benchmark results."""
+    cpu = platform.machine()
+    try:
+        with open("/proc/cpuinfo", "r") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    cpu = line.split(":", 1)[1].strip()
+                    break
+    except OSError:
+        pass
+    return "%s %s x%d" % (platform.node(), cpu, os.cpu_count() or 1)
+
+
+# Reference solution profiles (see autograder.benchmark()) read from
+# and saved to benchmarkCacheFile.
+benchmarkProfiles = {}
+
+def loadBenchmarkProfile(key):
+    """Returns the saved reference profile for key or None."""
+    if key not in benchmarkProfiles and benchmarkCacheFile is not None:
+        try:
+            with open(benchmarkCacheFile, "r") as f:
+                benchmarkProfiles.update(json.load(f))
+        except (OSError, ValueError):
+            pass
+    return benchmarkProfiles.get(key)
+
+def saveBenchmarkProfile(key, profile):
+    """Remembers the reference profile for key and writes it to benchmarkCacheFile."""
+    benchmarkProfiles[key] = profile
+    if benchmarkCacheFile is None:
+        return
+    saved = {}
+    try:
+        with open(benchmarkCacheFile, "r") as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        pass
+    saved[key] = profile
+    tmp = "%s.%d.tmp" % (benchmarkCacheFile, os.getpid())
+    with open(tmp, "w") as f:
+        json.dump(saved, f, indent=4)
+    os.replace(tmp, benchmarkCacheFile)
+
+
+def usageFromRusage(ru):
+    """Converts the resource usage returned by os.wait4() into a dictionary that can be stored in AUTOGRADE.json."""
+    # Note that Linux reports a maxRss that is at least as large as the
+    # autograder itself because the child shares the autograder's
+    # memory between (v)fork and exec. Use cgroups (cgroupMemoryPeak)
+    # for accurate numbers.
+    return { 'userTime':   round(ru.ru_utime, 4),  # seconds
+             'systemTime': round(ru.ru_stime, 4),  # seconds
+             'maxRss':     ru.ru_maxrss*1024,      # bytes (Linux reports KiB)
+             'minorFaults': ru.ru_minflt,
+             'majorFaults': ru.ru_majflt,
+             'voluntaryContextSwitches':   ru.ru_nvcsw,
+             'involuntaryContextSwitches': ru.ru_nivcsw,
+             'blockInput':  ru.ru_inblock,
+             'blockOutput': ru.ru_oublock }
+
+
+class Cgroup(object):
+    """A cgroup (version 2) for running a single command in. See useCgroups."""
+    counter = 0
+    # Set when setupRoot() has made sure the controllers are enabled.
+    rootReady = False
+
+    def __init__(self, memoryMax, pidsMax, cpuMax):
+        Cgroup.setupRoot()
+        Cgroup.counter += 1
+        self.path = os.path.join(cgroupRoot, "run-%d-%d" % (os.getpid(), Cgroup.counter))
+        os.mkdir(self.path)
+        self.procsFile = os.path.join(self.path, "cgroup.procs")
+        self.write("memory.max", memoryMax, required=True)
+        self.write("memory.swap.max", 0)
+        self.write("pids.max", pidsMax, required=True)
+        self.write("cpu.max", cpuMax, required=(cpuMax != "max"))
+
+    @staticmethod
+    def setupRoot():
+        """Create cgroupRoot and enable the controllers we need for the cgroups below it. Raises OSError if a controller we need can't be enabled."""
+        if Cgroup.rootReady:
+            return
+        # Other gradeAll() workers may be doing the same right now, so
+        # don't skip enabling the controllers if cgroupRoot exists.
+        os.makedirs(cgroupRoot, exist_ok=True)
+        for d in [ os.path.dirname(cgroupRoot), cgroupRoot ]:
+            with open(os.path.join(d, "cgroup.controllers"), "r") as f:
+                available = f.read().split()
+            for controller in [ "cpu", "memory", "pids" ]:
+                if controller in available:
+                    try:
+                        with open(os.path.join(d, "cgroup.subtree_control"), "w") as f:
+                            f.write("+" + controller)
+                    except OSError:
+                        # The controller might already be enabled, or
+                        # the parent cgroup contains processes.
+                        pass
+        with open(os.path.join(cgroupRoot, "cgroup.subtree_control"), "r") as f:
+            enabled = f.read().split()
+        needed = [ "memory", "pids" ] + ([ "cpu" ] if cgroupCpuMax != "max" else [])
+        missing = [ c for c in needed if c not in enabled ]
+        if missing:
+            raise OSError(errno.ENOTSUP, "Can't enable the cgroup controllers %s for %s" % (", ".join(missing), cgroupRoot))
+        Cgroup.rootReady = True
+
+    def write(self, name, value, required=False):
+        """Writes to a file in the cgroup. Files of controllers that are not available are ignored, unless required is True (then OSError is raised)."""
+        filename = os.path.join(self.path, name)
+        if os.path.exists(filename):
+            with open(filename, "w") as f:
+                f.write(str(value))
+        elif required:
+            raise OSError(errno.ENOENT, "Missing cgroup file (is its controller enabled?)", filename)
+
+    def read(self, name):
+        filename = os.path.join(self.path, name)
+        if not os.path.exists(filename):
+            return None
+        with open(filename, "r") as f:
+            return f.read()
+
+    def kill(self):
+        """Kills every process in the cgroup."""
+        try:
+            self.write("cgroup.kill", 1)
+        except OSError:
+            pass
+        # Older kernels don't have cgroup.kill
+        if not os.path.exists(os.path.join(self.path, "cgroup.kill")):
+            for pid in (self.read("cgroup.procs") or "").split():
+                try:
+                    os.kill(int(pid), signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+
+    def isPopulated(self):
+        events = self.read("cgroup.events") or ""
+        return "populated 1" in events
+
+    def usage(self):
+        """Returns the CPU time, peak memory and number of out-of-memory kills of all processes that ran in the cgroup."""
+        usage = {}
+        for line in (self.read("cpu.stat") or "").splitlines():
+            (key, value) = line.split()
+            if key == "usage_usec":
+                usage['cgroupCpuTime'] = int(value) / 1000000.0
+        peak = self.read("memory.peak")
+        if peak:
+            usage['cgroupMemoryPeak'] = int(peak)
+        for line in (self.read("memory.events") or "").splitlines():
+            (key, value) = line.split()
+            if key == "oom_kill":
+                usage['oomKills'] = int(value)
+        return usage
+
+    def remove(self):
+        """Kills any remaining processes and deletes the cgroup. Returns the final usage() of the cgroup."""
+        self.kill()
+        for i in range(100):
+            if not self.isPopulated():
+                break
+            time.sleep(.01)
+        usage = self.usage()
+        try:
+            os.rmdir(self.path)
+        except OSError:
+            pass
+        return usage
+
+
+def _utf8Prefix(data):
+    """Removes a UTF-8 character that was cut in half from the end of data."""
+    for i in range(1, min(4, len(data))+1):
+        byte = data[-i]
+        if byte < 0x80:
+            return data
+        if byte >= 0xC0:
+            # Lead byte: 110xxxxx, 1110xxxx or 11110xxx.
+            length = 2 if byte < 0xE0 else 3 if byte < 0xF0 else 4
+            return data if i >= length else data[:-i]
+    return data
+
+def _utf8Suffix(data):
+    """Removes the rest of a UTF-8 character that was cut in half from the beginning of data."""
+    for i in range(min(3, len(data))):
+        if not 0x80 <= data[i] < 0xC0:
+            return data[i:]
+    return data[min(3, len(data)):]
+
+
+class OutputCapture(object):
+    """Collects the output of a process in a bounded amount of memory: a head buffer with the beginning of the output and a ring buffer with the end of it. The total number of bytes and lines is counted. If openSpill is set and output has to be left out, openSpill() is called to open a file (or None) that receives the complete output."""
+    def __init__(self, limitBytes=None, headBytes=None, tailBytes=None, headLines=None, tailLines=None, openSpill=None):
+        if limitBytes is None:
+            limitBytes = captureLimitBytes
+        if headBytes is None:
+            headBytes = captureHeadBytes
+        if tailBytes is None:
+            tailBytes = captureTailBytes
+        if headLines is None and tailLines is None:
+            (headLines, tailLines) = (captureHeadLines, captureTailLines)
+        self.headBytes = headBytes
+        self.tailBytes = tailBytes
+        # Line limits: if one of them is set, the other one is 0.
+        self.lineLimits = None
+        if headLines is not None or tailLines is not None:
+            self.lineLimits = (headLines or 0, tailLines or 0)
+        # Keep enough at the beginning to show complete output that
+        # fits within limitBytes.
+        self.headSize = max(limitBytes - tailBytes, headBytes)
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.totalBytes = 0
+        self.totalLines = 0
+        self.endsWithNewline = True
+        self.openSpill = openSpill
+        self.spill = None
+        self.spilledBytes = 0
+
+    @classmethod
+    def fromFile(cls, filename, **kwargs):
+        """Returns an OutputCapture with the contents of filename, reading only the parts of the file that it keeps."""
+        capture = cls(**kwargs)
+        with open(filename, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size <= capture.headSize + capture.tailBytes:
+                capture.write(f.read())
+                return capture
+            capture.write(f.read(capture.headSize))
+            f.seek(size - capture.tailBytes)
+            capture.tail = bytearray(f.read(capture.tailBytes))
+            capture.totalBytes = size
+            capture.totalLines = None  # unknown, we didn't read the middle
+        return capture
+
+    def write(self, data):
+        self.totalBytes += len(data)
+        self.totalLines += data.count(b'\n')
+        if len(data) > 0:
+            self.endsWithNewline = data.endswith(b'\n')
+        if self.spill is not None:
+            self._spill(data)
+        room = self.headSize - len(self.head)
+        if room > 0:
+            self.head += data[:room]
+            data = data[room:]
+        if len(data) > 0:
+            self.tail += data
+            if len(self.tail) > self.tailBytes:
+                # Nothing was left out until now, so the spill file
+                # can still get all of the output.
+                self.startSpill()
+                del self.tail[:len(self.tail)-self.tailBytes]
+
+    def startSpill(self):
+        """Opens the spill file (see openSpill) if it isn't open yet and writes the output we have to it."""
+        if self.openSpill is None:
+            return
+        self.spill = self.openSpill()
+        self.openSpill = None
+        if self.spill is not None:
+            self._spill(self.head)
+            self._spill(self.tail)
+
+    def _spill(self, data):
+        room = outputArtifactLimitBytes - self.spilledBytes
+        if room > 0:
+            self.spill.write(data[:room])
+            self.spilledBytes += min(room, len(data))
+
+    def close(self):
+        """Finishes writing the spill file (if output was left out of getString(), it is opened now). Returns True if there is a spill file."""
+        if self.spill is None and self.isAbbreviated():
+            self.startSpill()
+        self.openSpill = None
+        if self.spill is None:
+            return False
+        self.spill.close()
+        return True
+
+    def isAbbreviated(self):
+        """True if some of the output was not kept (or isn't shown because of the line limits)."""
+        if self.totalBytes > len(self.head) + len(self.tail):
+            return True
+        if self.lineLimits is None:
+            return False
+        lines = self.totalLines + (0 if self.endsWithNewline else 1)
+        return lines > sum(self.lineLimits)
+
+    def getString(self):
+        """Returns the (potentially abbreviated) output as a string."""
+        if not self.isAbbreviated():
+            return (self.head + self.tail).decode("utf-8", errors="replace")
+        (head, tail) = (self.head, self.tail)
+        if self.totalBytes == len(self.head) + len(self.tail):
+            # Everything fit in memory, but there are too many lines.
+            head = tail = self.head + self.tail
+        head = head[:self.headBytes]
+        tail = tail[max(0, len(tail)-self.tailBytes):]
+        if self.lineLimits is not None:
+            (headLines, tailLines) = self.lineLimits
+            end = -1
+            for i in range(headLines):
+                end = head.find(b'\n', end+1)
+                if end == -1:
+                    break
+            else:
+                head = head[:end+1]
+            # Don't count a newline at the very end as another line.
+            start = len(tail) - 1
+            for i in range(tailLines):
+                start = tail.rfind(b'\n', 0, start)
+                if start == -1:
+                    break
+            else:
+                tail = tail[start+1:]
+        head = _utf8Prefix(bytes(head))
+        tail = _utf8Suffix(bytes(tail))
+        if self.totalLines is None:
+            about = "leaving out %d of %d bytes" % (self.totalBytes-len(head)-len(tail), self.totalBytes)
+        else:
+            about = "leaving out %d of %d bytes; the output had %d lines" % (self.totalBytes-len(head)-len(tail), self.totalBytes, self.totalLines)
+        retstring = head.decode("utf-8", errors="replace")
+        retstring += "\n\nSNIP SNIP SNIP (%s)\n\n" % about
+        retstring += tail.decode("utf-8", errors="replace")
+        return retstring
+
+
+class SupervisedChild(object):
+    """State that a Supervisor keeps about one child process."""
+    def __init__(self, pid):
+        self.pid = pid
+        self.pidfd = None
+        self.deadline = None
+        self.onTimeout = None
+        self.onExit = None
+        self.outputs = {}        # open pipes we read from -> onData function
+        self.inputs = {}         # open pipes we write to -> [data not written yet, close when done?]
+        self.timedOut = False
+        self.finished = False
+        self.lost = False        # True if we gave up waiting for the process to exit
+        self.returncode = None
+        self.rusage = None
+
+    def setTimeout(self, timeout):
+        """The process will be considered too slow timeout seconds from now. None means no timeout."""
+        if timeout is None:
+            self.deadline = None
+        else:
+            self.deadline = time.monotonic() + timeout
+
+
+class Supervisor(object):
+    """Waits for any number of child processes from a single thread.
+
+    Each child is watched through a pidfd (or polled with os.wait4()
+    if pidfds are not available) and has its own deadline. Data
+    written to the child's stdin and read from its stdout/stderr pipes
+    is handled in the same loop, so no thread is needed per process."""
+
+    # How long we wait for a process to go away after its onTimeout
+    # handler was called before giving up on it.
+    reapTimeout = 5
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.children = []
+
+    def close(self):
+        """Releases the file descriptors of the supervisor (its epoll file descriptor and the pidfds of children that haven't finished). Call it when done with the supervisor."""
+        for child in self.children:
+            if child.pidfd is not None:
+                os.close(child.pidfd)
+                child.pidfd = None
+        self.selector.close()
+
+    def add(self, pid, timeout=None, onTimeout=None, onExit=None):
+        """Start supervising process pid. onTimeout(child) is called when the process runs longer than timeout seconds, onExit(child) is called after it was reaped."""
+        child = SupervisedChild(pid)
+        child.onTimeout = onTimeout
+        child.onExit = onExit
+        child.setTimeout(timeout)
+        try:
+            child.pidfd = os.pidfd_open(pid)
+            self.selector.register(child.pidfd, selectors.EVENT_READ, (self._reap, child, None))
+        except (AttributeError, OSError):
+            child.pidfd = None
+        self.children.append(child)
+        return child
+
+    def addOutput(self, child, pipe, onData):
+        """Read everything written to pipe (a file object) and pass it to onData(bytes)."""
+        os.set_blocking(pipe.fileno(), False)
+        child.outputs[pipe] = onData
+        self.selector.register(pipe, selectors.EVENT_READ, (self._read, child, onData))
+
+    def addInput(self, child, pipe, data, close=True):
+        """Write data (bytes) to pipe (a file object) as the process reads it. If close is True, the pipe is closed once all data was written. addInput() can be called again on the same pipe to send more data as long as the pipe wasn't closed."""
+        if child.finished or pipe.closed:
+            return
+        if pipe not in child.inputs:
+            os.set_blocking(pipe.fileno(), False)
+            child.inputs[pipe] = [ bytearray(), False ]
+        child.inputs[pipe][0] += data
+        child.inputs[pipe][1] = close
+        self._write(child, pipe, child.inputs[pipe])
+
+    def _close(self, child, pipe):
+        if pipe in child.outputs:
+            del child.outputs[pipe]
+        elif pipe in child.inputs:
+            del child.inputs[pipe]
+        else:
+            return
+        if pipe in self.selector.get_map():
+            self.selector.unregister(pipe)
+        try:
+            pipe.close()
+        except OSError:
+            pass
+
+    def _read(self, child, pipe, onData):
+        # Read at most 1 MiB at a time so that a process that never
+        # stops writing can't keep us here forever.
+        for i in range(16):
+            try:
+                data = os.read(pipe.fileno(), 65536)
+            except BlockingIOError:
+                return
+            except OSError:
+                data = b''
+            if not data:
+                self._close(child, pipe)
+                return
+            onData(data)
+            if len(data) < 65536:
+                return
+
+    def _write(self, child, pipe, state):
+        (buf, close) = state
+        try:
+            while len(buf) > 0:
+                n = os.write(pipe.fileno(), buf[:65536])
+                del buf[:n]
+        except BlockingIOError:
+            pass
+        except OSError:
+            # An OSError (usually a broken pipe) occurs if the
+            # process exits or closes stdin without reading all of
+            # the data.
+            del buf[:]
+            close = True
+
+        # Only ask the selector about the pipe while we have
+        # something to write to it.
+        registered = pipe in self.selector.get_map()
+        if len(buf) > 0 and not registered:
+            self.selector.register(pipe, selectors.EVENT_WRITE, (self._write, child, state))
+        elif len(buf) == 0:
+            if registered:
+                self.selector.unregister(pipe)
+            if close:
+                self._close(child, pipe)
+
+    def _reap(self, child, pidfd=None, unused=None):
+        try:
+            (pid, status, rusage) = os.wait4(child.pid, os.WNOHANG)
+        except ChildProcessError:
+            # Somebody else reaped the process.
+            (pid, status, rusage) = (child.pid, None, None)
+        if pid == 0:
+            return
+        if status is not None:
+            child.returncode = os.waitstatus_to_exitcode(status)
+        child.rusage = rusage
+        self._finish(child)
+
+    def _finish(self, child):
+        # Collect any output that the process wrote before it exited
+        # and close the pipes. Processes that the child left behind
+        # could keep the pipes open forever.
+        for (pipe, onData) in list(child.outputs.items()):
+            self._read(child, pipe, onData)
+            self._close(child, pipe)
+        for pipe in list(child.inputs):
+            self._close(child, pipe)
+        if child.pidfd is not None:
+            self.selector.unregister(child.pidfd)
+            os.close(child.pidfd)
+            child.pidfd = None
+        child.finished = True
+        self.children.remove(child)
+        if child.onExit:
+            child.onExit(child)
+
+    def _checkDeadline(self, child, now):
+        if child.finished or child.deadline is None or now < child.deadline:
+            return
+        if child.onTimeout is not None or not child.timedOut:
+            child.timedOut = True
+            child.deadline = now + self.reapTimeout
+            # onTimeout() is called once. It can set a new timeout and
+            # onTimeout() to escalate (e.g., from SIGINT to SIGKILL).
+            onTimeout = child.onTimeout
+            child.onTimeout = None
+            if onTimeout:
+                onTimeout(child)
+        else:
+            # The process survived onTimeout() and the reap timeout
+            # (e.g., it is stuck in the kernel). Stop waiting for it
+            # instead of hanging the autograder.
+            child.lost = True
+            self._finish(child)
+
+    def _waitTime(self, timeout=None):
+        """Returns how long we can wait for events before we have to check on a child (None = forever), but not longer than timeout."""
+        now = time.monotonic()
+        for child in self.children:
+            if child.deadline is not None:
+                wait = max(child.deadline - now, 0)
+                if timeout is None or wait < timeout:
+                    timeout = wait
+            if child.pidfd is None and (timeout is None or timeout > .01):
+                timeout = .01  # poll os.wait4() for processes without a pidfd
+        return timeout
+
+    def poll(self, timeout=None):
+        """Wait up to timeout seconds (None = until the next deadline) for events and handle them."""
+        timeout = self._waitTime(timeout)
+        for key, mask in self.selector.select(timeout):
+            # An earlier handler may have closed this file.
+            if self.selector.get_map().get(key.fd) is not key:
+                continue
+            (handler, child, extra) = key.data
+            handler(child, key.fileobj, extra)
+
+        now = time.monotonic()
+        for child in list(self.children):
+            if child.pidfd is None and not child.finished:
+                self._reap(child)
+            self._checkDeadline(child, now)
+
+    def wait(self, children=None):
+        """Handle events until the given children (default: all of them) have finished."""
+        if children is None:
+            children = list(self.children)
+        while any(not c.finished for c in children):
+            self.poll()
+
+    async def wait_async(self, children=None):
+        """Same as wait(), but lets the asyncio event loop run other tasks until the children have finished."""
+        if children is None:
+            children = list(self.children)
+        loop = asyncio.get_running_loop()
+        while any(not c.finished for c in children):
+            # Wake up when the selector has events (the epoll file
+            # descriptor becomes readable) or when a deadline passes.
+            ready = loop.create_future()
+            def wakeup():
+                if not ready.done():
+                    ready.set_result(None)
+            try:
+                loop.add_reader(self.selector.fileno(), wakeup)
+            except (AttributeError, NotImplementedError):
+                ready.set_result(None)
+                await asyncio.sleep(min(self._waitTime(.01), .01))
+            try:
+                await asyncio.wait([ready], timeout=self._waitTime())
+            finally:
+                loop.remove_reader(self.selector.fileno())
+            self.poll(0)
+
+
+# While set (see autograder.gather()), records for the autograder log
+# are appended to this list instead of being added to the log.
+logBuffer = contextvars.ContextVar("logBuffer", default=None)
+
+# Files (and directories) the autograder writes into each submission
+# directory.
+reportFiles=("AUTOGRADE.html", "AUTOGRADE.json", "AUTOGRADE.results.json", "AUTOGRADE.output")
+
+
+# Characters that sanitizeString() shows as hex codes: anything that
+# isn't in string.printable (except for smart quotes).
+_unprintable = re.compile("[^%s‘’]" % re.escape(string.printable))
+
+class _HexTable(dict):
+    """str.translate() table that maps the characters matched by _unprintable to their hex codes and leaves others alone. Entries are added as characters are seen, for characters in the Basic Multilingual Plane only so that the table stays small."""
+    def __missing__(self, code):
+        if _unprintable.match(chr(code)):
+            value = "\\{0x%02x}" % code  # print value in hex so it looks like: \{0x02}
+        else:
+            value = chr(code)
+        if code < 0x10000:
+            self[code] = value
+        return value
+
+_hexTable = _HexTable()
+
+@functools.lru_cache(maxsize=1024)
+def compileIgnoreCase(pattern):
+    """Returns pattern compiled as a case insensitive regular expression. Patterns are cached for all submissions."""
+    return re.compile(pattern, re.IGNORECASE)
+
+
+def sanitizeString(instring, escape=True):
+    """Show odd characters in hex. Performs HTML escaping"""
+    if escape:
+        if "escape" in dir(cgi):  # cgi.escape() is deprecated in python 3.8
+            instring = cgi.escape(instring)
+        else:
+            instring = html.escape(instring)
+
+    # Strip \r, should be followed with \n
+    # Don't want to show two newline characters for lines with \r\n line endings.
+    out = instring.replace('\r', '').replace('\n', "&crarr;\n")
+    #out = out.replace('\t', "&rarr;")  # tab to right-arrow; messes up formatting too much.
+
+    # copy printable strings (digits, letters, punctuation,
+    # whitespace), nonprintable characters are shown in hex. Most
+    # output is plain text, so only translate if we have to.
+    if _unprintable.search(out):
+        out = out.translate(_hexTable)
+
+    # We could strip whitespace, but we don't want to strip
+    # whitespace from the strings that we are saying that we are
+    # searching for.
+
+    return out
+
+
+# An autograder report is a list of records (dictionaries). Every
+# record has a 'kind':
+#
+#   header, footer: Beginning and end of the report ('title' is the username).
+#   heading: A section heading ('message').
+#   entry: A line of the report ('message', 'deduction').
+#   check: The result of a check like stringMustContain() ('check' is
+#          the name of the check, 'passed' tells if it passed).
+#   run, usage: How a command exited ('retcode', 'elapsedTime') and
+#          the resources it used ('usage'). 'run' is the index of the
+#          command in autograderRuns in AUTOGRADE.json.
+#   output: Output of a command ('stream' is stdout, stderr or stdin).
+#          If it was abbreviated, 'artifact' may name a compressed
+#          file with all of it (see outputArtifacts).
+#   session: Interaction with a program through a Session.
+#   benchmark: Timing table of autograder.benchmark() ('results').
+#   file: Contents of a file ('filename').
+#   total: The final score ('score').
+#   html, lineNumber: HTML written with autograder.log().
+#
+# Rows of the report have a 'line' number. 'message' is plain text;
+# if a row has 'html', it is shown instead of 'message'. 'pre' is text
+# shown preformatted below the message. Other keys (e.g., 'cmd') give
+# details for programs that read AUTOGRADE.results.json.
+
+def recordToHtml(record):
+    """Returns a list of lines of HTML for one record of an autograder report."""
+    kind = record['kind']
+    if kind == 'html':
+        return [ record['html'] ]
+    if kind == 'lineNumber':
+        return [ "<td>%d</td>" % record['line'] ]
+    if kind == 'header':
+        return [ "<!DOCTYPE html>",
+                 "<html lang='en'>",
+                 "<head>",
+                 "<meta charset='utf-8'>",
+                 "<title>%s - Autograder report</title>" % record['title'],
+                 "<style>",
+                 "table, th, td { border: 1px solid #eee; margin: 0px; border-collapse: collapse; border-spacing: 0px; margin: 0px; }",
+                 "table td:nth-child(1) { font-family: monospace; text-align: right; color: #999; }",
+                 "table td:nth-child(2) { color: darkred; font-weight: bold; font-size: 130%; text-align: center }",
+                 "table { width: 100%; }",
+                 "div.preformatcode { max-height: 20em; width: 80vw; overflow: auto; background-color: #eee; resize: both; }",
+                 "h2 { margin: 0px; font-size: 130%; }",
+                 "pre { margin: 2px; white-space: pre-wrap}",
+                 "body { font-family: sans }",
+                 "</style>",
+                 "</head><body>",
+                 "<h1>%s</h1>" % record['title'],
+                 # Google Gmail web interface got rid of the preview option so
+                 # everybody has to download the file to view it now.
+                 # "<p><i>Gmail users:</i> This page may be easier to read if you download the file and then view it (Gmail removes some of the formatting).",
+                 "<table>",
+                 "<tr><th></th><th>Points</th><th>Details</th></tr>" ]
+    if kind == 'total':
+        return [ "<tr><td></td><td><b><span style='font-size: 140%%'>%s</span></b></td><td><b>TOTAL</b></td></tr>" % record['score'] ]
+    if kind == 'footer':
+        return [ "</table></body></html>" ]
+
+    details = record.get('html')
+    if details is None and 'message' in record:
+        details = sanitizeString(record['message'])
+    if kind == 'heading':
+        return [ "<tr>", "<td>%d</td>" % record['line'], "<td></td><td><h2>%s</h2></td></tr>" % details ]
+
+    details = details or ""
+    if 'artifact' in record:
+        details += " <a href='%s'>(complete output)</a>" % html.escape(record['artifact'])
+    if 'pre' in record:
+        details += "<div class='preformatcode'><pre>%s</pre></div>" % sanitizeString(record['pre'])
+    scoreString = ""
+    if record.get('deduction', 0) != 0:
+        scoreString = "%d" % record['deduction']
+    return [ "<tr>", "<td>%d</td>" % record['line'], "<td>%s</td><td>%s</td></tr>" % (scoreString, details) ]
+
+
+def renderHtml(records):
+    """Returns an autograder report (a list of records) as HTML."""
+    lines = []
+    for record in records:
+        lines += recordToHtml(record)
+    return "".join([ line + "\n" for line in lines ])
+
+
+def renderText(records):
+    """Returns an autograder report (a list of records) as plain text."""
+    out = []
+    for record in records:
+        kind = record['kind']
+        if kind == 'header':
+            out.append("Autograder report for %s" % record['title'])
+        elif kind == 'heading':
+            out.append("")
+            out.append("== %s ==" % record['message'])
+        elif kind == 'total':
+            out.append("TOTAL: %s" % record['score'])
+        elif 'line' in record and kind != 'lineNumber':
+            message = record.get('message')
+            if message is None and 'html' in record:
+                message = html.unescape(re.sub(r"<[^>]*>", "", record['html'].replace("<br>", "\n")))
+            deduction = ""
+            if record.get('deduction', 0) != 0:
+                deduction = "%d" % record['deduction']
+            out.append("%4d %4s  %s" % (record['line'], deduction, (message or "").replace("\n", "\n" + " "*11)))
+            if 'artifact' in record:
+                out.append("           (complete output: %s)" % record['artifact'])
+            if 'pre' in record:
+                out += [ "           | " + line for line in record['pre'].splitlines() ]
+    return "\n".join(out) + "\n"
+
 
 # http://stackoverflow.com/questions/1191374/subprocess-with-timeout
 class Command(object):
-    def __init__(self, cmd):
+    def __init__(self, cmd, cwd=None, capture=None):
         self.cmd = cmd
         self.cmdShort = cmd[0]
         self.cmdSpaces = " ".join(cmd)
+        self.cwd = cwd  # directory to run in (None = current directory)
+        # Arguments for OutputCapture (e.g., { 'headLines': 20 }) that
+        # decide how much output is shown in the report.
+        self.capture = capture or {}
         self.process = None
+        self.child = None
 
         self.timeout = 1
 
         self.stdoutdata = ""
         self.stderrdata = ""
+        self.stdoutCapture = None
+        self.stderrCapture = None
+        self.stdoutArtifact = None  # files with the complete output (see outputArtifacts)
+        self.stderrArtifact = None
         self.retcode = 0
         self.didRun = False
         self.tooSlow = False
+        self.elapsedTime = 0
+        self.usage = None
+        self.cgroup = None
+
+
+    def launcher(self):
+        """Returns the helper programs to run the command through and extra subprocess.Popen() arguments. The helpers put the process into its cgroup, set resource limits and switch to the autograder user, so no Python code has to run between fork and exec."""
+        if not os.path.exists(setprivPath) or not os.path.exists(prlimitPath):
+            return ([], { 'preexec_fn': self.setProcessLimits })
+
+        launcher = []
+        if self.cgroup is not None:
+            # Runs as root: move this shell into the cgroup before
+            # replacing it with the rest of the command line.
+            launcher += [ "/bin/sh", "-c", 'echo $$ > "$0" && exec "$@"', self.cgroup.procsFile ]
+
+        launcher += [ prlimitPath ]
+        for (name, limitType, limit) in [ ("nproc", resource.RLIMIT_NPROC, "ULIMIT_NPROC"),
+                                          ("as",    resource.RLIMIT_AS,    "ULIMIT_AS"),
+                                          ("data",  resource.RLIMIT_DATA,  "ULIMIT_DATA"),
+                                          ("fsize", resource.RLIMIT_FSIZE, "ULIMIT_FSIZE") ]:
+            if limit in os.environ:
+                limit = int(os.environ[limit])
+                (soft, hard) = resource.getrlimit(limitType)
+                if hard > 0 and limit > hard:
+                    limit = hard
+                launcher += [ "--%s=%d" % (name, limit) ]
+        launcher += [ "--" ]
+
+        if switchUser:
+            launcher += [ setprivPath, "--reuid=%d" % autograderUid, "--keep-groups", "--" ]
+
+        # Put all processes in the same process group so we can kill
+        # it and all children it creates.
+        if sys.version_info >= (3, 11):
+            kwargs = { 'process_group': 0 }
+        else:
+            kwargs = { 'start_new_session': True }
+        return (launcher, kwargs)
 
 
     def setProcessLimits(x):
@@ -85,6 +1450,12 @@ class Command(object):
         # printed here will look like the program that we are calling
         # printed them out.
 
+        # Move into our cgroup while we are still allowed to (i.e.,
+        # before switching users).
+        if x.cgroup is not None:
+            with open(x.cgroup.procsFile, "w") as f:
+                f.write(str(os.getpid()))
+
         #print("pre switch user")
         if switchUser:
             os.setreuid(autograderUid,autograderUid)
@@ -117,205 +1488,626 @@ class Command(object):
         limitHelper(resource.RLIMIT_NPROC, "ULIMIT_NPROC")
         limitHelper(resource.RLIMIT_AS, "ULIMIT_AS")
         limitHelper(resource.RLIMIT_DATA, "ULIMIT_DATA")
+        limitHelper(resource.RLIMIT_FSIZE, "ULIMIT_FSIZE")
 
 
-    def run(self, autogradeobj, timeout=5, stdindata=None, workToDoWhileRunning=None):
-        def target():
+    def prepare(self, killStrays=True):
+        """Makes sure that we won't run submitted code as root and kills any processes left behind by earlier commands (if killStrays is True)."""
+        if switchUser==False and os.geteuid() == 0:
+            print("Don't set switchUser==False and grade student submissions as root since student submissions would be run as root.")
+            exit(1)
 
-            #print("target %s"%str(self.cmd))
-            # To print current number of used processes, run: ps -eLF | grep $USER | wc -l
-            os.environ["ULIMIT_NPROC"] = str(1024*4)            # Maximum number of processes
-            os.environ["ULIMIT_DATA"]  = str(1024*1024*1024*8)  # 8 GB of memory
-            os.environ["ULIMIT_FSIZE"] = str(1024*1024*1024*50) # 50 GB of space for files
+        if switchUser==True and os.geteuid() != 0:
+            print("If switchUser==True, you should run this as root.")
+            exit(1)
 
-            limitString  = "%s: Limits are " % self.cmdShort
-            limitString += "time="  + str(timeout) + "sec "
-            limitString += "memory=" + autogradeobj.humanSize(int(os.environ["ULIMIT_DATA"]))  + " "
-            limitString += "fsize="  + autogradeobj.humanSize(int(os.environ["ULIMIT_FSIZE"])) + " "
+        if switchUser==True and os.geteuid() == 0:
+            # Don't kill processes if the user is intentionally running multiple processes via workToDoWhileRunning() function
+            if killStrays and threading.active_count() == 1:
+                killUserProcesses(autograderUid)
 
-            msg='%s: Thread started: <b>%s</b><br>' % (self.cmdShort, self.cmdSpaces)
-            msg+=limitString
-            autogradeobj.log_generic(msg, deductPoints=0, needSanitize=False)
-            startTime = time.time()
 
-            try:
-                # write stderr/stdout to temp file in case students print tons of stuff out.
-                #print("mkstemp %s"%str(self.cmd))
-                stdoutFile = tempfile.mkstemp(prefix="ag-"+autogradeobj.username+"-stdout-")
-                stderrFile = tempfile.mkstemp(prefix="ag-"+autogradeobj.username+"-stderr-")
-                #print("popen %s"%str(self.cmd))
-
-                # If we run the program directly, stdout and stderr
-                # messages might not be fully written out before a
-                # program crashes---making it difficult for students
-                # to see what is going on. stdbuf seems to be the best
-                # way to fix this. unbuffer also works but seems to
-                # make the autograder fail to detect segfaults.
-                fixBuffering = []
-                if os.path.exists("/usr/bin/stdbuf"):
-                    # Disabled stderr and stdout buffering; leave stdin buffering
-                    fixBuffering = [ "/usr/bin/stdbuf", "-o0", "-e0" ]
-                elif os.path.exists("/usr/bin/unbuffer"):
-                    fixBuffering = ["/usr/bin/unbuffer"]
-                if len(fixBuffering) > 0:
-                    # stdbuf and unbuffer make our code fail to
-                    # produce an OSerror when the program doesn't
-                    # exist. So, we raise an OSError ourself if we
-                    # can't find the executable.
-                    if autogradeobj.which(self.cmd[0]) == None:
-                        raise OSError
-
-                my_env = os.environ.copy()
-                my_env["GCC_COLORS"] = ""
-                my_env["TERM"]="dumb"
-
-                if stdindata:
-                    self.process = subprocess.Popen(fixBuffering+self.cmd, stdin=subprocess.PIPE, stdout=stdoutFile[0], stderr=stderrFile[0], preexec_fn=self.setProcessLimits, env=my_env)
-                    with autogradeobj.logLock:
-                        autogradeobj.log("<tr>")
-                        autogradeobj.log_lineNumber()
-                        autogradeobj.log("<td></td><td>%s: Data sent to stdin:" % self.cmdShort)
-                        autogradeobj.log_pre(str(stdindata))
-                        autogradeobj.log("</td></tr>")
-                    try:
-                        # An IOError can occur if we can't write or close due to a broken pipe.
-                        self.process.stdin.write(bytes(stdindata, encoding='ascii'))
-                        self.process.stdin.close()
-                    except:
-                        pass
-                else:
-                    # No stdin provided.
-                    self.process = subprocess.Popen(fixBuffering+self.cmd, stdout=stdoutFile[0], stderr=stderrFile[0], preexec_fn=self.setProcessLimits, env=my_env)
-
-                #print("wait %s"%str(self.cmd))
-                self.process.wait()
-                #print("wait after - %s"%str(self.cmd))
-
-                # Close the temp files we wrote to, get an
-                # (potentially abbreviated) string from the file,
-                # delete the file.
-                #print("close stdout - %s"%str(self.cmd))
-                os.close(stdoutFile[0])
-                self.stdoutdata = autogradeobj.get_abbrv_string_from_file(stdoutFile[1])
-                os.unlink(stdoutFile[1])
-
-                #print("close stderr - %s"%str(self.cmd))
-                os.close(stderrFile[0])
-                self.stderrdata = autogradeobj.get_abbrv_string_from_file(stderrFile[1])
-                os.unlink(stderrFile[1])
-
-                self.retcode = self.process.returncode
-                self.didRun = True
-            except OSError as e:
-                autogradeobj.log_addEntry("%s: Unable to start process: %s" % (self.cmdShort, self.cmdSpaces))
-                self.didRun = False
-            elapsedTime = "%0.2fsec" % (time.time()-startTime)
-            if self.retcode < 0:
-                autogradeobj.log_addEntry('%s: Exited after %s due to signal %d %s' % (self.cmdShort, elapsedTime, -self.retcode, autogradeobj.signal_to_string(-self.retcode)))
+    def start(self, autogradeobj, supervisor, timeout=5, stdindata=None, interactive=False, onOutput=None):
+        """Starts the command and registers it with supervisor. The process is considered too slow after timeout seconds (None = never). Call finish() after supervisor reports that the process has finished. Returns False if the process could not be started.
+
+        If interactive is True, stdin is left open so that data can be sent to the process with supervisor.addInput(). onOutput(bytes), if set, is called with everything the process writes to stdout."""
+        self.autogradeobj = autogradeobj
+        self.timeout = timeout
+
+        # To print current number of used processes, run: ps -eLF | grep $USER | wc -l
+        os.environ["ULIMIT_NPROC"] = str(1024*4)            # Maximum number of processes
+        os.environ["ULIMIT_DATA"]  = str(1024*1024*1024*8)  # 8 GB of memory
+        os.environ["ULIMIT_FSIZE"] = str(1024*1024*1024*50) # 50 GB of space for files
+
+        limitString  = "%s: Limits are " % self.cmdShort
+        limitString += "time="  + str(timeout) + "sec "
+        limitString += "memory=" + autogradeobj.humanSize(int(os.environ["ULIMIT_DATA"]))  + " "
+        limitString += "fsize="  + autogradeobj.humanSize(int(os.environ["ULIMIT_FSIZE"])) + " "
+        if useCgroups:
+            self.cgroup = Cgroup(memoryMax=os.environ["ULIMIT_DATA"], pidsMax=os.environ["ULIMIT_NPROC"], cpuMax=cgroupCpuMax)
+            limitString += "cpu=" + cgroupCpuMax + " "
+
+        msg='%s: Process started: <b>%s</b><br>' % (autogradeobj.sanitize_string(self.cmdShort), autogradeobj.sanitize_string(self.cmdSpaces))
+        msg+=autogradeobj.sanitize_string(limitString)
+        autogradeobj.log_entry('entry', message="%s: Process started: %s\n%s" % (self.cmdShort, self.cmdSpaces, limitString), html=msg, cmd=self.cmd, timeout=timeout)
+        self.startTime = time.time()
+
+        try:
+            # If we run the program directly, stdout and stderr
+            # messages might not be fully written out before a
+            # program crashes---making it difficult for students
+            # to see what is going on. stdbuf seems to be the best
+            # way to fix this. unbuffer also works but seems to
+            # make the autograder fail to detect segfaults.
+            fixBuffering = []
+            if os.path.exists("/usr/bin/stdbuf"):
+                # Disabled stderr and stdout buffering; leave stdin buffering
+                fixBuffering = [ "/usr/bin/stdbuf", "-o0", "-e0" ]
+            elif os.path.exists("/usr/bin/unbuffer"):
+                fixBuffering = ["/usr/bin/unbuffer"]
+            (launcher, kwargs) = self.launcher()
+            if len(launcher+fixBuffering) > 0:
+                # stdbuf, unbuffer and the launcher helpers make our
+                # code fail to produce an OSerror when the program
+                # doesn't exist. So, we raise an OSError ourself if we
+                # can't find the executable.
+                if autogradeobj.which(os.path.join(self.cwd or "", self.cmd[0]) if os.sep in self.cmd[0] else self.cmd[0]) == None:
+                    raise OSError
+
+            my_env = os.environ.copy()
+            my_env["GCC_COLORS"] = ""
+            my_env["TERM"]="dumb"
+
+            # stdout and stderr are read from pipes into bounded
+            # buffers in case students print tons of stuff out.
+            if stdindata or interactive:
+                self.process = subprocess.Popen(launcher+fixBuffering+self.cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=my_env, cwd=self.cwd, **kwargs)
             else:
-                autogradeobj.log_addEntry('%s: Exited after %s with return code %d' % (self.cmdShort, elapsedTime, self.retcode))
+                # No stdin provided.
+                self.process = subprocess.Popen(launcher+fixBuffering+self.cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=my_env, cwd=self.cwd, **kwargs)
+        except OSError as e:
+            autogradeobj.log_addEntry("%s: Unable to start process: %s" % (self.cmdShort, self.cmdSpaces))
+            if self.cgroup is not None:
+                self.cgroup.remove()
+                self.cgroup = None
+            self.didRun = False
+            self.finish()
+            return False
+
+        self.child = supervisor.add(self.process.pid, timeout, onTimeout=self.terminate)
+        self.stdoutCapture = OutputCapture(openSpill=lambda: autogradeobj.openOutputArtifact(self, "stdout"), **self.capture)
+        self.stderrCapture = OutputCapture(openSpill=lambda: autogradeobj.openOutputArtifact(self, "stderr"), **self.capture)
+        if onOutput is None:
+            supervisor.addOutput(self.child, self.process.stdout, self.stdoutCapture.write)
+        else:
+            def onStdout(data):
+                self.stdoutCapture.write(data)
+                onOutput(data)
+            supervisor.addOutput(self.child, self.process.stdout, onStdout)
+        supervisor.addOutput(self.child, self.process.stderr, self.stderrCapture.write)
+        if stdindata:
+            autogradeobj.log_entry('output', message="%s: Data sent to stdin:" % self.cmdShort, pre=str(stdindata), cmd=self.cmd, stream='stdin')
+            supervisor.addInput(self.child, self.process.stdin, bytes(stdindata, encoding='ascii'))
+        return True
 
-        # END definition of target() function.
 
+    def terminate(self, child):
+        """Called by the supervisor when the process runs longer than the timeout."""
+        self.autogradeobj.log_addEntry("%s: Ran for more than %g seconds. Terminating process..." % (self.cmdShort, self.timeout))
+        self.tooSlow = True
+
+        # Try to politely kill the process. If it is still running
+        # after terminateGrace seconds, the supervisor calls
+        # kill(). If it exits sooner, finish() kills anything it left
+        # behind right away.
         try:
-            if switchUser==False and os.geteuid() == 0:
-                print("Don't set switchUser==False and grade student submissions as root since student submissions would be run as root.")
-                exit(1)
+            os.killpg(self.process.pid, signal.SIGINT) # send Ctrl+C to process group
+        except ProcessLookupError:
+            # ProcessLookupError occurs if the process group is
+            # already gone.
+            pass
+        child.setTimeout(terminateGrace)
+        child.onTimeout = lambda child: self.kill()
+
+
+    def kill(self):
+        """Kills the process and everything it started."""
+        if self.cgroup is not None:
+            self.cgroup.kill()
+            return
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL) # kill the process group
+        except ProcessLookupError:
+            pass
+
+
+    def finish(self):
+        """Collects the output of a process that has finished and logs how it exited."""
+        autogradeobj = self.autogradeobj
+        if self.child is not None:
+            self.process.returncode = self.child.returncode
+            if self.tooSlow:
+                self.kill()
+            self.stdoutdata = self.stdoutCapture.getString()
+            self.stderrdata = self.stderrCapture.getString()
+            # Finish the files with the complete output (if any).
+            self.stdoutCapture.close()
+            self.stderrCapture.close()
+
+            if self.child.lost:
+                autogradeobj.log_addEntry("%s: Process could not be stopped. Giving up on it." % self.cmdShort)
+            else:
+                self.retcode = self.child.returncode
+                self.didRun = True
 
-            if switchUser==True and os.geteuid() != 0:
-                print("If switchUser==True, you should run this as root.")
-                exit(1)
+        self.elapsedTime = time.time()-self.startTime
+        elapsedTime = "%0.2fsec" % self.elapsedTime
+        if self.retcode < 0:
+            msg = '%s: Exited after %s due to signal %d %s' % (self.cmdShort, elapsedTime, -self.retcode, autogradeobj.signal_to_string(-self.retcode))
+        else:
+            msg = '%s: Exited after %s with return code %d' % (self.cmdShort, elapsedTime, self.retcode)
+        autogradeobj.log_entry('run', message=msg, cmd=self.cmd, run=len(autogradeobj.runs), retcode=self.retcode, elapsedTime=round(self.elapsedTime, 4), tooSlow=self.tooSlow)
+
+        cgroupUsage = {}
+        if self.cgroup is not None:
+            # This also kills any processes that the command left behind.
+            cgroupUsage = self.cgroup.remove()
+            self.cgroup = None
+
+        if self.child is not None and self.child.rusage is not None:
+            self.usage = usageFromRusage(self.child.rusage)
+            self.usage.update(cgroupUsage)
+            if self.usage.get('oomKills', 0) > 0:
+                autogradeobj.log_addEntry('%s: A process was killed because it used more than %s of memory.' % (self.cmdShort, autogradeobj.humanSize(int(os.environ["ULIMIT_DATA"]))))
+            autogradeobj.log_entry('usage', message='%s: Used %s' % (self.cmdShort, autogradeobj.usage_to_string(self.usage)), cmd=self.cmd, run=len(autogradeobj.runs), usage=self.usage)
+
+        # Remember what ran and how many resources it used so it can
+        # be saved in AUTOGRADE.json.
+        autogradeobj.runs.append({ 'cmd': self.cmd,
+                                   'didRun': self.didRun,
+                                   'tooSlow': self.tooSlow,
+                                   'retcode': self.retcode,
+                                   'elapsedTime': round(self.elapsedTime, 4),
+                                   'usage': self.usage })
+
+        autogradeobj.checkScratchBudget()
+
+
+    def run(self, autogradeobj, timeout=5, stdindata=None, workToDoWhileRunning=None, onOutput=None):
+        self.prepare()
+        supervisor = Supervisor()
+        try:
+            if not self.start(autogradeobj, supervisor, timeout=timeout, stdindata=stdindata, onOutput=onOutput):
+                return (self.didRun, self.tooSlow, self.retcode, self.stdoutdata, self.stderrdata)
 
-            if switchUser==True and os.geteuid() == 0:
-                # Don't kill processes if the user is intentionally running multiple processes via workToDoWhileRunning() function
-                if threading.activeCount() == 1:
-                    import pwd
-                    username = pwd.getpwuid(autograderUid)[0]
-                    subprocess.call(['killall', '-u', username, '-SIGINT'])
-                    time.sleep(.1)
-                    subprocess.call(['killall', '-u', username, '-SIGSTOP'])
-                    time.sleep(.1)
-                    subprocess.call(['killall', '-u', username, '-SIGKILL'])
-
-            #print("prepare thread - %s"%str(self.cmd))
-            thread = threading.Thread(target=target)
-            #print("start thread - %s"%str(self.cmd))
-
-            thread.start()
-            if workToDoWhileRunning:
-                # time.sleep(.2) # give time for process to start.
-                #
-                # IMPORTANT: If workToDoWhileRunning hangs, then our
-                # timeout mechanism won't work because we will not
-                # return from this function.
-                workToDoWhileRunning()
-            #print("join before - %s"%str(self.cmd))
-            thread.join(timeout)
-            #print("join after - %s"%str(self.cmd))
-
-            if switchUser and os.geteuid() == 0:
-                os.chown(autogradeobj.logFile, normalUid, -1)
-
-
-            # Check to see if we timed out
-            self.tooSlow = False
-            if thread.is_alive():
-                autogradeobj.log_addEntry("%s: Ran for more than %d seconds. Terminating process..." % (self.cmdShort, timeout))
-                self.tooSlow = True
-
-                # Try to politely kill the process
-                if self.process != None:
+            try:
+                if workToDoWhileRunning:
+                    # IMPORTANT: If workToDoWhileRunning hangs, then our
+                    # timeout mechanism won't work because we will not
+                    # return from this function.
+                    #
+                    # Keep reading the program's output and writing its
+                    # input in another thread meanwhile, so the program
+                    # doesn't block on a full pipe.
+                    self.child.setTimeout(None)
+                    stop = threading.Event()
+                    def drain():
+                        while not stop.is_set() and not self.child.finished:
+                            supervisor.poll(.05)
+                    drainer = threading.Thread(target=drain, daemon=True)
+                    drainer.start()
                     try:
-                        #print("killpg 1 - %s"%str(self.cmd))
-                        os.killpg(self.process.pid, signal.SIGINT) # send Ctrl+C to process group
-                        # self.process.send_signal(signal.SIGINT)    # send Ctrl+C to the parent process
-                        time.sleep(.3)  # give process a chance to cleanup (for example valgrind printing its final summary)
-                        #print("killpg 2 - %s"%str(self.cmd))
-                        os.killpg(self.process.pid, signal.SIGKILL) # kill the process group
-                    except ProcessLookupError:
-                        # print("ProcessLookupError - %s"%str(self.cmd))
-                        #
-                        # ProcessLookupError occurs if the PID is
-                        # already killed. This seems to happen
-                        # sometimes when we try to write to
-                        # stdin.
-                        pass
+                        workToDoWhileRunning()
+                    finally:
+                        stop.set()
+                        drainer.join()
+                    # The timeout starts after workToDoWhileRunning() returns.
+                    self.child.setTimeout(timeout)
+                supervisor.wait([self.child])
+
+            # Without this, Ctrl+C will cause python to exit---but we will
+            # be forced to wait until the process we are running times out
+            # too. With this, we try to exit gracefully.
+            except KeyboardInterrupt as e:
+                self.kill()
+                if self.cgroup is not None:
+                    self.cgroup.remove()
+                raise
+        finally:
+            supervisor.close()
+
+        self.finish()
+        return (self.didRun, self.tooSlow, self.retcode, self.stdoutdata, self.stderrdata)
 
-                    # Make sure that we join up with the thread. It should be dead now.
-                    thread.join(.5)
 
-            # In the unlikely event the thread is still alive, exit so
-            # we know something went wrong.
-            if thread.is_alive():
-                print("%s: We failed to kill thread after timeout was reached. Exiting." % self.cmdShort)
-                exit(1)
+    def runCached(self, autogradeobj, cache, timeout=5, stdindata=None, workToDoWhileRunning=None):
+        """Same as run(), but if this command already ran on identical files with the same tools, the files it created are restored from cache (a BuildCache) and its output is reused instead of running it again."""
+        workDir = self.cwd or os.getcwd()
+        # Leftover processes could change workDir while we hash it or
+        # restore files into it.
+        self.prepare()
+        key = cache.key(self.cmd, stdindata, workDir)
+        entry = cache.get(key)
+        if entry is None:
+            before = cache.snapshot(workDir)
+            self.run(autogradeobj, timeout=timeout, stdindata=stdindata, workToDoWhileRunning=workToDoWhileRunning)
+            # Don't save anything if the command was killed; it may
+            # just have been unlucky.
+            if self.didRun and not self.tooSlow:
+                self.prepare()
+                cache.put(key, self, before, workDir)
+            return (self.didRun, self.tooSlow, self.retcode, self.stdoutdata, self.stderrdata)
 
+        try:
+            cache.restore(key, entry, workDir)
+        except OSError as e:
+            autogradeobj.log_addEntry("%s: Couldn't reuse the result of an identical earlier build (%s); running it again." % (self.cmdShort, e))
+            return self.run(autogradeobj, timeout=timeout, stdindata=stdindata, workToDoWhileRunning=workToDoWhileRunning)
+        self.autogradeobj = autogradeobj
+        self.didRun = True
+        self.retcode = entry['retcode']
+        self.stdoutdata = entry['stdout']
+        self.stderrdata = entry['stderr']
+        self.usage = entry['usage']
+        autogradeobj.log_entry('run', message='%s: Reused the result of an identical earlier build (it exited after %0.2fsec with return code %d)' % (self.cmdShort, entry['elapsedTime'], self.retcode),
+                               cmd=self.cmd, run=len(autogradeobj.runs), retcode=self.retcode, elapsedTime=entry['elapsedTime'], cached=True)
+        autogradeobj.runs.append({ 'cmd': self.cmd,
+                                   'didRun': True,
+                                   'tooSlow': False,
+                                   'retcode': self.retcode,
+                                   'elapsedTime': entry['elapsedTime'],
+                                   'usage': self.usage,
+                                   'cached': True })
+        return (self.didRun, self.tooSlow, self.retcode, self.stdoutdata, self.stderrdata)
 
-        # Without this, Ctrl+C will cause python to exit---but we will
-        # be forced to wait until the process we are running times out
-        # too. With this, we try to exit gracefully.
-        except KeyboardInterrupt as e:
-            os.killpg(self.process.pid, signal.SIGKILL)
-            thread.join(.5)
-            raise
 
+    async def run_async(self, autogradeobj, timeout=5, stdindata=None):
+        """Same as run(), but other asyncio tasks can run (e.g., other commands) while we wait for the process."""
+        # Leftover processes are only killed if no other command is
+        # running at the same time.
+        self.prepare(killStrays=(autogradeobj.runningAsync == 0))
+        supervisor = Supervisor()
+        try:
+            if not self.start(autogradeobj, supervisor, timeout=timeout, stdindata=stdindata):
+                return (self.didRun, self.tooSlow, self.retcode, self.stdoutdata, self.stderrdata)
+
+            autogradeobj.runningAsync += 1
+            try:
+                await supervisor.wait_async([self.child])
+            except (KeyboardInterrupt, asyncio.CancelledError):
+                self.kill()
+                supervisor.wait([self.child])
+                if self.cgroup is not None:
+                    self.cgroup.remove()
+                raise
+            finally:
+                autogradeobj.runningAsync -= 1
+        finally:
+            supervisor.close()
+
+        self.finish()
         return (self.didRun, self.tooSlow, self.retcode, self.stdoutdata, self.stderrdata)
 
 
+class Session(object):
+    """An interactive conversation with a running program. Use autograder.session() to create one.
+
+    send() writes to the program's stdin without blocking, expect()
+    waits for output that matches a regular expression and
+    read_available() returns whatever the program printed so far. Each
+    exchange is written to the autograder log along with the time (in
+    seconds) since the program started."""
+
+    # Keep at most this much unread stdout.
+    maxBuffered = 1024*1024
+
+    def __init__(self, autogradeobj, exe, timeout=5):
+        self.autogradeobj = autogradeobj
+        self.cmd = Command(exe)
+        self.supervisor = Supervisor()
+        self.output = ""   # stdout that hasn't been consumed by expect() or read_available()
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.closed = False
+        autogradeobj.openSessions += 1
+        self.cmd.prepare()
+        self.startTime = time.monotonic()
+        self.running = self.cmd.start(autogradeobj, self.supervisor, timeout=timeout, interactive=True, onOutput=self._onOutput)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    def _onOutput(self, data):
+        self.output += self.decoder.decode(data)
+        if len(self.output) > self.maxBuffered:
+            self.output = self.output[-self.maxBuffered:]
+
+    def _log(self, msg, text=None, deductPoints=0):
+        msg = "%s: [%0.3fsec] %s" % (self.cmd.cmdShort, time.monotonic()-self.startTime, msg)
+        self.autogradeobj.log_entry('session', message=msg, deductPoints=deductPoints, pre=text, cmd=self.cmd.cmd)
+
+    def isRunning(self):
+        """Returns True if the program has not exited yet."""
+        return self.running and not self.cmd.child.finished
+
+    def send(self, data):
+        """Sends data (a string) to the program's stdin. Returns immediately, even if the program isn't reading its input."""
+        self._log("Sent to stdin:", data)
+        if self.running:
+            self.supervisor.addInput(self.cmd.child, self.cmd.process.stdin, data.encode("utf-8"), close=False)
+            self.supervisor.poll(0)
+
+    def close_stdin(self):
+        """Closes the program's stdin. The program reads end-of-file after it has read everything that was sent."""
+        self._log("Closed stdin.")
+        if self.running:
+            self.supervisor.addInput(self.cmd.child, self.cmd.process.stdin, b"", close=True)
+
+    def expect(self, pattern, timeout=1, deductPoints=0):
+        """Waits up to timeout seconds for the program to print something to stdout that matches the regular expression pattern. The output up to the end of the match is consumed. Returns the match object, or None (and deducts points) if nothing matched in time."""
+        regex = re.compile(pattern)
+        deadline = time.monotonic() + timeout
+        match = regex.search(self.output)
+        while not match and self.isRunning():
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            self.supervisor.poll(deadline-now)
+            match = regex.search(self.output)
+
+        if match:
+            consumed = self.output[:match.end()]
+            self.output = self.output[match.end():]
+            self._log("Output matched '%s':" % pattern, consumed)
+        else:
+            self._log("Output did not match '%s' within %g seconds. Unread output:" % (pattern, timeout), self.output, deductPoints)
+        return match
+
+    def read_available(self):
+        """Returns (and consumes) everything the program has printed to stdout that wasn't consumed yet. Does not wait."""
+        if self.isRunning():
+            self.supervisor.poll(0)
+        text = self.output
+        self.output = ""
+        self._log("Read from stdout:", text)
+        return text
+
+    def close(self):
+        """Closes stdin and waits for the program to exit (it is killed if it runs longer than the timeout given to session()). Any output that wasn't read yet is logged. Returns (didRun, tooSlow, retcode, stdoutdata, stderrdata) like autograder.run(), where stdoutdata is the stdout that wasn't consumed."""
+        if self.closed:
+            return (self.cmd.didRun, self.cmd.tooSlow, self.cmd.retcode, self.output, self.cmd.stderrdata)
+        self.closed = True
+        self.autogradeobj.openSessions -= 1
+        try:
+            if self.running:
+                self.supervisor.addInput(self.cmd.child, self.cmd.process.stdin, b"", close=True)
+                try:
+                    self.supervisor.wait([self.cmd.child])
+                except KeyboardInterrupt:
+                    self.cmd.kill()
+                    raise
+                self.cmd.finish()
+        finally:
+            self.supervisor.close()
+
+        if len(self.output) > 0:
+            self._log("Unread stdout:", self.output)
+        if len(self.cmd.stderrdata) > 0:
+            self._log("stderr:", self.cmd.stderrdata)
+        return (self.cmd.didRun, self.cmd.tooSlow, self.cmd.retcode, self.output, self.cmd.stderrdata)
+
+
+class TestCase(object):
+    """One row of a test table for autograder.run_tests().
+
+    args: Command to run (a list, like for run()).
+    stdin: String sent to the program on stdin.
+    files: Dictionary of filename -> contents (string or bytes) created in the test's directory before the program runs.
+    expectExitCode: Exit code the program should return (None = don't check).
+    contains / notContains: Strings that stdout must / must not contain (case insensitive).
+    regex: Regular expressions that stdout must match (case insensitive).
+    points: Points deducted if any of the checks fail.
+    timeout: Seconds the program may run.
+    name: Name of the test shown in the log."""
+
+    def __init__(self, args, stdin=None, files={}, expectExitCode=0, contains=[], notContains=[], regex=[], points=0, timeout=5, name=None):
+        self.args = args
+        self.stdin = stdin
+        self.files = files
+        self.expectExitCode = expectExitCode
+        self.contains = contains
+        self.notContains = notContains
+        self.regex = regex
+        self.points = points
+        self.timeout = timeout
+        self.name = name or " ".join(args)
+
+
+def restoreFiles(filesFd, entry, workDir):
+    """Deletes and copies files in workDir like BuildCache.restore() says. filesFd is an open file descriptor for the directory with the saved files."""
+    for relpath in entry['deleted']:
+        path = os.path.join(workDir, relpath)
+        if os.path.lexists(path):
+            os.remove(path)
+    for f in entry['files']:
+        dst = os.path.join(workDir, f['path'])
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        if os.path.lexists(dst):
+            os.remove(dst)
+        # Copy without the original timestamps so that the restored
+        # files are newer than the sources (like they would be after
+        # running make).
+        if stat.S_ISLNK(os.stat(f['path'], dir_fd=filesFd, follow_symlinks=False).st_mode):
+            os.symlink(os.readlink(f['path'], dir_fd=filesFd), dst)
+            continue
+        srcFd = os.open(f['path'], os.O_RDONLY|os.O_NOFOLLOW, dir_fd=filesFd)
+        with open(srcFd, "rb") as src:
+            dstFd = os.open(dst, os.O_WRONLY|os.O_CREAT|os.O_EXCL|os.O_NOFOLLOW, 0o600)
+            with open(dstFd, "wb") as out:
+                shutil.copyfileobj(src, out)
+                os.fchmod(dstFd, f['mode'])
+
+
+class BuildCache(object):
+    """Saves the files that a build command created or changed in a directory, keyed on the files the command started with, the tools it may use and the command line."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def key(self, cmd, stdindata, workDir):
+        """Returns the cache key for running cmd in workDir."""
+        h = hashlib.sha256()
+        h.update(json.dumps([ cmd, stdindata ]).encode("utf-8"))
+        for tool in buildCacheTools:
+            path = shutil.which(tool)
+            if path is not None:
+                st = os.stat(path)
+                h.update(("\0tool %s %s %d %d" % (tool, os.path.realpath(path), st.st_size, st.st_mtime_ns)).encode("utf-8"))
+        for var in buildCacheEnv:
+            h.update(("\0env %s=%s" % (var, os.environ.get(var))).encode("utf-8"))
+        return treeDigest(workDir, h).hexdigest()
+
+    def snapshot(self, workDir):
+        """Returns a dictionary of the files and symlinks in workDir: relative path -> (inode, size, mtime, mode)."""
+        files = {}
+        for path, dirs, filenames in os.walk(workDir):
+            for f in filenames + [ d for d in dirs if os.path.islink(os.path.join(path, d)) ]:
+                st = os.lstat(os.path.join(path, f))
+                files[os.path.relpath(os.path.join(path, f), workDir)] = (st.st_ino, st.st_size, st.st_mtime_ns, st.st_mode)
+        return files
+
+    def entryDir(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        """Returns the saved result for key (a dictionary) or None if there isn't one."""
+        try:
+            with open(os.path.join(self.entryDir(key), "result.json"), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key, cmd, before, workDir, stdoutFile=None):
+        """Saves the files in workDir that are new or different from the snapshot before, along with the output of cmd (a Command that has finished). stdoutFile is a file with the complete stdout of cmd to save as well."""
+        after = self.snapshot(workDir)
+        entry = { 'cmd': cmd.cmd,
+                  'retcode': cmd.retcode,
+                  'stdout': cmd.stdoutdata,
+                  'stderr': cmd.stderrdata,
+                  'elapsedTime': round(cmd.elapsedTime, 4),
+                  'usage': cmd.usage,
+                  'files': [],
+                  'deleted': sorted(set(before) - set(after)) }
+
+        os.makedirs(os.path.dirname(self.entryDir(key)), exist_ok=True)
+        # Fill in a temporary directory and rename it when it is
+        # complete so a worker grading another submission never sees a
+        # half-written entry.
+        tmp = tempfile.mkdtemp(dir=os.path.dirname(self.entryDir(key)))
+        try:
+            for relpath in sorted(after):
+                if before.get(relpath) == after[relpath]:
+                    continue
+                dst = os.path.join(tmp, "files", relpath)
+                # workDir belongs to the programs being graded: don't
+                # follow symlinks they made into files root can read.
+                # restoreFiles() reads the copies as the sandbox user.
+                src = openRegularFile(workDir, relpath)
+                if src is not None:
+                    os.makedirs(os.path.dirname(dst), mode=0o755, exist_ok=True)
+                    with src, open(dst, "xb") as f:
+                        shutil.copyfileobj(src, f)
+                        os.fchmod(f.fileno(), 0o644)
+                elif stat.S_ISLNK(after[relpath][3]):
+                    os.makedirs(os.path.dirname(dst), mode=0o755, exist_ok=True)
+                    os.symlink(os.readlink(os.path.join(workDir, relpath)), dst)
+                else:
+                    continue
+                entry['files'].append({ 'path': relpath, 'mode': stat.S_IMODE(after[relpath][3]) })
+            if stdoutFile is not None:
+                shutil.copyfile(stdoutFile, os.path.join(tmp, "stdout"))
+
+            with open(os.path.join(tmp, "result.json"), "w") as f:
+                json.dump(entry, f)
+            os.rename(tmp, self.entryDir(key))
+        except OSError:
+            # Another worker saved the same entry first.
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def restore(self, key, entry, workDir):
+        """Makes workDir look the way it did after the command that produced entry finished. Raises OSError if that fails."""
+        # The entry's directory is only accessible to root, so open it
+        # here and let the sandbox user (who owns workDir) do the rest
+        # through the file descriptor.
+        filesDir = os.path.join(self.entryDir(key), "files")
+        filesFd = os.open(filesDir, os.O_RDONLY|os.O_DIRECTORY) if os.path.isdir(filesDir) else None
+        try:
+            asSandboxUser(restoreFiles, filesFd, entry, workDir)
+        finally:
+            if filesFd is not None:
+                os.close(filesFd)
+
+
+class ReferenceCache(BuildCache):
+    """Saves the output and the files created by a reference solution, keyed on its command line, its input (stdin and the files in the directory it runs in) and a hash of the reference program."""
+
+    def key(self, cmd, stdindata, workDir):
+        """Returns the cache key for running the reference solution cmd in workDir."""
+        h = hashlib.sha256()
+        h.update(json.dumps([ cmd, stdindata ]).encode("utf-8"))
+        program = cmd[0] if os.sep in cmd[0] else shutil.which(cmd[0]) or cmd[0]
+        h.update(("\0program %s" % fileHash(program, "sha256")).encode("utf-8"))
+        return treeDigest(workDir, h).hexdigest()
+
+
 class autograder():
     def __init__(self, username, totalPoints=100):
         self.lineNumber = 0
         self.logPointsTotal = totalPoints
+        # Information about each command that was run (see Command.finish())
+        self.runs = []
+        # Number of commands currently running via run_async()
+        self.runningAsync = 0
+        # Number of sessions (see session()) that haven't been closed
+        self.openSessions = 0
+        # Directory for the complete output of programs whose output
+        # was abbreviated (see outputArtifacts), created when needed.
+        self.outputDir = None
+        self.outputArtifactCount = 0
+        # Number of directories made by reference() and
+        # expect_same_as_reference() to run programs in.
+        self.runDirCount = 0
+        # Directory for their stdout and the files the reference
+        # solution made, created when needed. Unlike tempdir, the
+        # programs being graded can't write to it.
+        self.privateDir = None
 
 
         # The temporary location of the autograder report file. It
         # will be moved to the student submission directory when the
         # autograder is complete (i.e., cleanup() is called).
-        self.tempdir = tempfile.mkdtemp(prefix="autograder-"+username+"-")
+        self.onScratch = False
+        if scratchDir is not None and os.path.isdir(scratchDir):
+            fs = os.statvfs(scratchDir)
+            if fs.f_bavail * fs.f_frsize > scratchBudgetBytes and \
+               dirSize(os.path.join(os.getcwd(), username)) < scratchBudgetBytes:
+                self.onScratch = True
+        self.tempdir = tempfile.mkdtemp(prefix="autograder-"+username+"-", dir=scratchDir if self.onScratch else None)
+        if self.onScratch and not mountScratch(self.tempdir):
+            os.rmdir(self.tempdir)
+            self.onScratch = False
+            self.tempdir = tempfile.mkdtemp(prefix="autograder-"+username+"-")
         if switchUser:
             os.chown(self.tempdir, autograderUid, 0)
             os.chmod(self.tempdir, 0o770)
         self.logFile = os.path.join(self.tempdir, "report.html")
+        # The records that make up the report (see renderHtml()). The
+        # first recordsWritten of them have been written to logFile.
+        self.records = []
+        self.recordsWritten = 0
+        self.logFlushTime = time.time()
         # Prevent multiple threads from writing to log file at same time.
         self.logLock = threading.Lock()
 
@@ -334,6 +2126,10 @@ class autograder():
             os.chmod(self.workingDirectory, 0o770)
         self.username = username
 
+        # Hashes of the submission and the grading script, saved in
+        # AUTOGRADE.json so we can tell if the report is out of date.
+        self.fingerprint = fingerprint(self.directory)
+
         # Copy the student's submission into the working
         # directory. The only thing that needs to be copied back to
         # the original submission is the AUTOGRADE.txt file.
@@ -342,32 +2138,7 @@ class autograder():
         # Print a header for this student to the console and log file.
         print(bcolors.BOLD + username + bcolors.ENDC)
 
-        self.log("<!DOCTYPE html>")
-        self.log("<html lang='en'>")
-        self.log("<head>")
-        self.log("<meta charset='utf-8'>")
-        self.log("<title>%s - Autograder report</title>" % username)
-        self.log("<style>")
-        self.log("table, th, td { border: 1px solid #eee; margin: 0px; border-collapse: collapse; border-spacing: 0px; margin: 0px; }")
-
-        self.log("table td:nth-child(1) { font-family: monospace; text-align: right; color: #999; }")
-        self.log("table td:nth-child(2) { color: darkred; font-weight: bold; font-size: 130%; text-align: center }")
-
-        self.log("table { width: 100%; }")
-        self.log("div.preformatcode { max-height: 20em; width: 80vw; overflow: auto; background-color: #eee; resize: both; }")
-        self.log("h2 { margin: 0px; font-size: 130%; }")
-        self.log("pre { margin: 2px; white-space: pre-wrap}")
-        self.log("body { font-family: sans }")
-
-        self.log("</style>")
-
-        self.log("</head><body>")
-        self.log("<h1>%s</h1>"%username)
-        # Google Gmail web interface got rid of the preview option so
-        # everybody has to download the file to view it now.
-        # self.log("<p><i>Gmail users:</i> This page may be easier to read if you download the file and then view it (Gmail removes some of the formatting).")
-        self.log("<table>")
-        self.log("<tr><th></th><th>Points</th><th>Details</th></tr>")
+        self.log_record({ 'kind': 'header', 'title': username })
 
         self.log_addEntry("Autograder ran at: %s" % str(datetime.datetime.now().ctime()))
 
@@ -449,7 +2220,7 @@ class autograder():
             self.logPointsTotal = 0
 
         # Appends the student's total score to the log file.
-        self.log("<tr><td></td><td><b><span style='font-size: 140%%'>%s</span></b></td><td><b>TOTAL</b></td></tr>" % self.logPointsTotal)
+        self.log_record({ 'kind': 'total', 'score': self.logPointsTotal })
 
         # Since we don't actually use negative scores in grading and since students don't like to see them, we make them less noticeable.
         if origScore < 0:
@@ -462,7 +2233,8 @@ class autograder():
         self.log_addEntry("Reports sent AFTER the deadline will be used by the grader/TA/instructor to assist with grading. Your actual grade may differ from what this report says.")
         self.log_addEntry("Want to talk to the grader? If you have any information that the instructor or TA should know about when grading your submission, please leave a comment on your submission in Canvas. Go to the assignment or submission page and look for a link named 'Submission details'. If you have an urgent question or find an autograder bug, email your instructor.")
 
-        self.log("</table></body></html>")
+        self.log_record({ 'kind': 'footer' })
+        self.log_flush()
 
         # move autograde file to its final destination (in the
         # original directory, not the working directory)
@@ -475,6 +2247,38 @@ class autograder():
         print("Score: %d" % self.logPointsTotal)
         print("Wrote: %s" % logFileDest)
 
+        # Save the records the report was made from so other programs
+        # don't have to read the HTML.
+        resultsFile = os.path.join(self.directory, "AUTOGRADE.results.json")
+        with open(resultsFile, "w") as f:
+            json.dump({ 'username': self.username,
+                        'score': self.logPointsTotal,
+                        'records': self.records }, f, separators=(',', ':'))
+        if os.geteuid() == 0:
+            os.chown(resultsFile, normalUid, normalGid)
+
+        # Keep the complete output of the programs whose output was
+        # abbreviated in the report (see outputArtifacts).
+        outputDest = os.path.join(self.directory, "AUTOGRADE.output")
+        if os.path.exists(outputDest):
+            shutil.rmtree(outputDest)
+        linked = set(r['artifact'] for r in self.records if 'artifact' in r)
+        if linked:
+            os.mkdir(outputDest)
+            for artifact in sorted(linked):
+                dest = os.path.join(self.directory, artifact)
+                shutil.move(os.path.join(self.outputDir, os.path.basename(artifact)), dest)
+                if os.geteuid() == 0:
+                    os.chown(dest, normalUid, normalGid)
+            if os.geteuid() == 0:
+                os.chown(outputDest, normalUid, normalGid)
+        if self.outputDir is not None:
+            shutil.rmtree(self.outputDir)
+            self.outputDir = None
+        if self.privateDir is not None:
+            shutil.rmtree(self.privateDir)
+            self.privateDir = None
+
         metadataFile = os.path.join(self.directory, "AUTOGRADE.json")
         metadata = {}
         if os.path.exists(metadataFile):
@@ -489,6 +2293,8 @@ class autograder():
         metadata['emailCtime'] = ""
         metadata['autograderScore'] = self.logPointsTotal
         metadata['autograderScorePreAdjustment'] = origScore
+        metadata['autograderRuns'] = self.runs
+        metadata['autograderFingerprint'] = self.fingerprint
 
         # Dump the metadata back out to the file.
         with open(metadataFile, "w") as f:
@@ -499,18 +2305,33 @@ class autograder():
             os.chown(metadataFile, normalUid, normalGid)
             os.chown(logFileDest, normalUid, normalGid)
 
-        shutil.rmtree(self.tempdir)
+        if self.onScratch:
+            unmountScratch(self.tempdir)
+        else:
+            shutil.rmtree(self.tempdir)
         self.tempdir = None
         self.workingDirectory = None
+        hashCache.save()
 
 
     def skip(self):
         """Same as cleanup() but discards any autograding that may have occured---leaves the submission directory unchanged."""
         os.chdir(self.origwd)
         shutil.rmtree(self.workingDirectory)
-        shutil.rmtree(self.tempdir)
+        if self.onScratch:
+            unmountScratch(self.tempdir)
+        else:
+            shutil.rmtree(self.tempdir)
         if os.path.exists(self.logFile):
             os.remove(self.logFile)
+        if self.outputDir is not None:
+            shutil.rmtree(self.outputDir)
+            self.outputDir = None
+        if self.privateDir is not None:
+            shutil.rmtree(self.privateDir)
+            self.privateDir = None
+        self.records = []
+        hashCache.save()
 
     def isGraded(self):
         """Returns true if this submission needs to be autograded. A submission needs to be autograded if AUTOGRADE.json is missing, if AUTOGRADE.html is missing, or if the autograderScore is missing from AUTOGRADE.json"""
@@ -541,32 +2362,59 @@ class autograder():
             shutil.rmtree(self.workingDirectory)
 
 
-        # Copy the original submission back into the working directory
-        shutil.copytree(self.directory, self.workingDirectory)
-
+        # Copy the original submission back into the working
+        # directory, except for files we don't need in our working
+        # directory (and files the students shouldn't see).
+        #
         # Make sure both the autograder UID and root can access the
         # file. We'll make files owned by autograder and in the root
         # group. Both with read/write (+x for directories).
         if switchUser:
-            os.chown(self.workingDirectory, autograderUid, 0)
-            os.chmod(self.workingDirectory, 0o770)
-
-            for path, dirs, files in os.walk(self.workingDirectory):
-                os.chown(path, autograderUid, 0)
-                os.chmod(path, 0o770)
-                for f in files:
-                    os.chown(os.path.join(path,f), autograderUid, 0)
-                    os.chmod(os.path.join(path,f), stat.S_IREAD|stat.S_IWRITE|stat.S_IRGRP|stat.S_IWGRP)
-
-        # Delete files we don't need in our working directory (and
-        # files the students shouldn't see).
-        self.delete(os.path.join(self.workingDirectory, "AUTOGRADE.html"), quiet=True)
-        self.delete(os.path.join(self.workingDirectory, "AUTOGRADE.json"), quiet=True)
+            copyTree(self.directory, self.workingDirectory, uid=autograderUid,
+                     fileMode=stat.S_IREAD|stat.S_IWRITE|stat.S_IRGRP|stat.S_IWGRP, dirMode=0o770,
+                     hardlinks=pristineHardlinks, skip=reportFiles)
+        else:
+            copyTree(self.directory, self.workingDirectory, skip=reportFiles)
 
         # Change into the working directory again.
         os.chdir(self.workingDirectory)
 
 
+    def checkScratchBudget(self):
+        """If the temporary directory is in scratchDir and uses more than scratchBudgetBytes, moves it to the normal temporary directory on disk."""
+        # Don't move files out from under programs that are running.
+        if not self.onScratch or self.runningAsync > 0 or self.openSessions > 0:
+            return
+        if dirSize(self.tempdir) <= scratchBudgetBytes:
+            return
+
+        oldTempdir = self.tempdir
+        newTempdir = tempfile.mkdtemp(prefix="autograder-"+self.username+"-")
+        print("%s: Uses more than %s in %s, moving it to %s" % (self.username, self.humanSize(scratchBudgetBytes), scratchDir, newTempdir))
+        # copyTree() leaves out FIFOs and other special files that
+        # programs may have made.
+        os.rmdir(newTempdir)
+        try:
+            copyTree(oldTempdir, newTempdir, symlinks=True)
+            for path, dirs, files in os.walk(newTempdir):
+                for name in [ "" ] + dirs + files:
+                    st = os.lstat(os.path.join(oldTempdir, os.path.relpath(os.path.join(path, name), newTempdir)))
+                    os.lchown(os.path.join(path, name), st.st_uid, st.st_gid)
+        except OSError as e:
+            print("%s: Couldn't move %s to %s, keeping it in %s: %s" % (self.username, oldTempdir, newTempdir, scratchDir, e))
+            shutil.rmtree(newTempdir, ignore_errors=True)
+            return
+
+        cwd = os.getcwd()
+        self.tempdir = newTempdir
+        self.logFile = os.path.join(newTempdir, os.path.relpath(self.logFile, oldTempdir))
+        self.workingDirectory = os.path.join(newTempdir, os.path.relpath(self.workingDirectory, oldTempdir))
+        if os.path.commonpath([ cwd, oldTempdir ]) == oldTempdir:
+            os.chdir(os.path.join(newTempdir, os.path.relpath(cwd, oldTempdir)))
+        unmountScratch(oldTempdir)
+        self.onScratch = False
+
+
     def chownDir(self, path, owner, group):
         if not os.path.exists(path):
             return
@@ -610,21 +2458,25 @@ class autograder():
             return "Unknown signal #" + str(signalNumber)
 
 
-    def get_abbrv_string_from_file(self, filename):
-        if not os.path.exists(filename):
-            return "Can't read from " + filename + " because it doesn't exist."
+    def usage_to_string(self, usage):
+        """Describes a resource usage dictionary (see usageFromRusage()) in a human readable way."""
+        retstring = "%0.2fsec user + %0.2fsec system CPU time, max RSS %s (includes the autograder), %d page faults (%d major), %d context switches (%d involuntary), block I/O %d in / %d out" % \
+            (usage['userTime'], usage['systemTime'], self.humanSize(usage['maxRss']),
+             usage['minorFaults']+usage['majorFaults'], usage['majorFaults'],
+             usage['voluntaryContextSwitches']+usage['involuntaryContextSwitches'], usage['involuntaryContextSwitches'],
+             usage['blockInput'], usage['blockOutput'])
+        if 'cgroupCpuTime' in usage:
+            retstring += "; all processes together: %0.2fsec CPU time" % usage['cgroupCpuTime']
+        if 'cgroupMemoryPeak' in usage:
+            retstring += ", peak memory %s" % self.humanSize(usage['cgroupMemoryPeak'])
+        return retstring
 
-        with open(filename, 'r', encoding="utf-8", errors='replace') as f:
-            if os.path.getsize(filename) > 10000:
-                retstring = f.read(4000)
-                retstring += "\n\nSNIP SNIP SNIP (leaving out some of the output!)\n\n"
-                # f.seek(-4000, os.SEEK_END)
-                f.seek(os.path.getsize(filename)-4000)
-                retstring += f.read(4000)
-            else:
-                retstring = f.read()
 
-        return retstring
+    def get_abbrv_string_from_file(self, filename, capture=None):
+        """Returns the contents of filename, abbreviated the same way as the output of a program. capture holds arguments for OutputCapture (e.g., { 'headLines': 20 }); the file is only read as far as needed."""
+        if not os.path.exists(filename):
+            return "Can't read from " + filename + " because it doesn't exist."
+        return OutputCapture.fromFile(filename, **(capture or {})).getString()
 
 
     # http://stackoverflow.com/questions/800197/
@@ -658,7 +2510,7 @@ class autograder():
         self.log_addEntry("Expecting all of these files to exist: " + str(filenames))
         for f in filenames:
             if not glob.glob(f):
-                self.log_addEntry("Missing a file that we expected: " + str(f), deductPoints)
+                self.log_check("expect_file_all_of", False, "Missing a file that we expected: " + str(f), deductPoints, filename=f)
                 returnVal = False
 
         return returnVal
@@ -673,7 +2525,7 @@ class autograder():
             if glob.glob(f):
                 return True
 
-        self.log_addEntry("Did not find one of the expected files.", deductPoints)
+        self.log_check("expect_file_one_of", False, "Did not find one of the expected files.", deductPoints, filenames=filenames)
         return False
 
     def expect_file_none_of(self, filenames, deductPoints=0, delete=False):
@@ -699,14 +2551,14 @@ class autograder():
         # If there are other files, deduct points for them.
         for f in filesInDir:
             filesize = self.humanSize(os.stat(f).st_size)
-            self.log_addEntry("Unexpected file: %s (%s)" % (f, filesize), deductPoints)
+            self.log_check("expect_only_files", False, "Unexpected file: %s (%s)" % (f, filesize), deductPoints, filename=f)
 
     def incorrect_files(self, wrongFiles, deductPoints=0):
         """If any of the files in "files" exist, deduct points. Filenames can be regular expressions."""
         self.log_addEntry("These files should not be in the directory: " + str(wrongFiles))
         for f in wrongFiles:
             for g in glob.glob(f):
-                self.log_addEntry("This file shouldn't exist: \"" + g + "\"", deductPoints)
+                self.log_check("incorrect_files", False, "This file shouldn't exist: \"" + g + "\"", deductPoints, filename=g)
 
 
     def find_unexpected_subdirectories(self, expected_dirs, deductPoints = 0):
@@ -719,7 +2571,7 @@ class autograder():
 
         # If there are other files, deduct points for them.
         for f in dirs:
-            self.log_addEntry("Unexpected directory: " + str(f), deductPoints)
+            self.log_check("find_unexpected_subdirectories", False, "Unexpected directory: " + str(f), deductPoints, filename=f)
 
     def log_pre(self, msg):
         """Prints a preformatted message to the autogarder log. Call log_addEntryRaw() if you wish to print a full line (line number, score, in table) with preformatting."""
@@ -728,52 +2580,94 @@ class autograder():
 
     def log_lineNumber(self):
         """Prints a line number to the autogarder log."""
-        self.log("<td>%d</td>" % self.lineNumber)
-        self.lineNumber+=1
+        self.log_record({ 'kind': 'lineNumber', 'line': None })
 
 
     def log(self, msg):
-        """Prints a message to the autograder log."""
-        # print(msg)
-        with open(self.logFile, "a") as myfile:
-            myfile.write(msg +'\n')
-
-    def log_generic(self, msg, deductPoints=0, needSanitize=1, raw=0):
-        if not msg:
+        """Prints a message (HTML) to the autograder log."""
+        self.log_record({ 'kind': 'html', 'html': msg })
+
+    def log_record(self, record):
+        """Adds a record (see renderHtml()) to the autograder log. Records with a 'line' are numbered."""
+        buffer = logBuffer.get()
+        if buffer is not None:
+            # Line numbers are assigned when the buffer is written out.
+            buffer.append(record)
             return
+        if 'line' in record:
+            record['line'] = self.lineNumber
+            self.lineNumber+=1
+        self.records.append(record)
+        if logFlushSeconds is not None and time.time() - self.logFlushTime > logFlushSeconds:
+            self.log_flush()
+
+    def log_flush(self):
+        """Writes the records of the autograder log that haven't been written yet to the log file."""
+        self.logFlushTime = time.time()
+        # Only write what is there now: another thread may be adding records.
+        n = len(self.records)
+        html = renderHtml(self.records[self.recordsWritten:n])
+        self.recordsWritten = n
+        with open(self.logFile, "a") as myfile:
+            myfile.write(html)
+        # Let the main user look at partial reports.
+        if switchUser and os.geteuid() == 0:
+            os.chown(self.logFile, normalUid, -1)
+
+    def log_flushBuffer(self, buffer):
+        """Adds records held back in buffer (see gather()) to the autograder log."""
+        for record in buffer:
+            self.log_record(record)
+        del buffer[:]
+
+    def log_entry(self, kind, message=None, deductPoints=0, html=None, pre=None, artifact=None, **fields):
+        """Adds a row to the autograder log and deducts deductPoints. message is plain text. If html is set, it is shown instead of message. pre is shown preformatted below it. artifact is a file (relative to the report) that the row links to. kind and fields are saved in AUTOGRADE.results.json to describe the row (see renderHtml())."""
+        # Make sure deductPoints is a negative number!
+        deductPoints = -abs(deductPoints)
+        record = { 'kind': kind, 'line': None, 'deduction': deductPoints }
+        if message is not None:
+            record['message'] = message
+        if html is not None:
+            record['html'] = html
+        if pre is not None:
+            record['pre'] = pre
+        if artifact is not None:
+            record['artifact'] = artifact
+        record.update(fields)
 
         with self.logLock:
-            if needSanitize and raw==0:
-                msg = self.sanitize_string(msg)
-
-            if msg.startswith('==='):
-                msg = msg.replace('===', '')
-                msg = msg.strip()
-                print(msg)
-                self.log("<tr>")
-                self.log_lineNumber()
-                self.log("<td></td><td><h2>%s</h2></td></tr>" % msg)
-                return
-
-            # Make sure deductPoints is a negative number!
-            if deductPoints > 0:
-                deductPoints = -deductPoints
-
-            scoreString = ""
             if deductPoints != 0:
-                scoreString = "%s" % str(deductPoints)
                 self.logPointsTotal = self.logPointsTotal + deductPoints
                 # Print point deductions to console too.
-                print("%d - %s" % (deductPoints, msg))
-
-            self.log("<tr>")
-            self.log_lineNumber()
-            if raw:
-                self.log("<td>%s</td><td>" % scoreString)
-                self.log_pre(msg)
-                self.log("</td></tr>")
+                print("%d - %s" % (deductPoints, message if message is not None else pre))
+            self.log_record(record)
+
+    def log_check(self, check, passed, message, deductPoints=0, pre=None, html=None, **fields):
+        """Logs the result of a check (e.g., "stringMustContain"). Points are only deducted if the check didn't pass."""
+        if passed:
+            deductPoints = 0
+        self.log_entry('check', message, deductPoints, html=html, pre=pre, check=check, passed=passed, **fields)
+
+    def log_generic(self, msg, deductPoints=0, needSanitize=1, raw=0):
+        if not msg:
+            return
+
+        if msg.startswith('==='):
+            msg = msg.replace('===', '')
+            msg = msg.strip()
+            print(msg)
+            if needSanitize:
+                self.log_record({ 'kind': 'heading', 'line': None, 'message': msg })
             else:
-                self.log("<td>%s</td><td>%s</td></tr>" % (scoreString, msg))
+                self.log_record({ 'kind': 'heading', 'line': None, 'html': msg })
+            return
+
+        if raw:
+            self.log_entry('entry', deductPoints=deductPoints, pre=msg)
+        elif needSanitize:
+            self.log_entry('entry', message=msg, deductPoints=deductPoints)
+        else:
+            self.log_entry('entry', deductPoints=deductPoints, html=msg)
 
 
     def log_addEntry(self, msg, deductPoints=0):
@@ -785,15 +2679,13 @@ class autograder():
 
 
 
-    def log_file_contents(self, filename):
-        """Writes the contents of a file to the autograder log"""
+    def log_file_contents(self, filename, capture=None):
+        """Writes the contents of a file to the autograder log. capture limits how much of it is shown (see get_abbrv_string_from_file())."""
         if not os.path.exists(filename):
             self.log_addEntry("File %s doesn't exist, can't display it." % filename)
             return
 
-        msg = "File '%s' contains:" % filename
-        msg += "<div class='preformatcode'><pre>%s</pre></div>" % self.sanitize_string(self.get_abbrv_string_from_file(filename))
-        self.log_generic(msg, needSanitize=False)
+        self.log_entry('file', message="File '%s' contains:" % filename, pre=self.get_abbrv_string_from_file(filename, capture), filename=filename)
 
 
     def find_first_matching_file(self, filenames):
@@ -813,43 +2705,55 @@ class autograder():
 
     def sanitize_string(self, instring, escape=True):
         """Show odd characters in hex. Performs HTML escaping"""
-        if escape:
-            if "escape" in dir(cgi):  # cgi.escape() is deprecated in python 3.8
-                instring = cgi.escape(instring)
-            else:
-                instring = html.escape(instring)
-
-
-        out=""
-        for i in instring:
-            if i == '‘':    #smart quote
-                out += '‘'
-            elif i == '’':  #smart quote
-                out += '’'
-            elif i == '\r':
-                # Strip, should be followed with \n
-                # Don't want to show two newline characters for lines with \r\n line endings.
-                continue
-            elif i == '\n':
-                out += "&crarr;\n"
-            #elif i == '\t':       # tab to right-arrow
-            #    out += "&rarr;"   # messes up formatting too much.
-            elif i in string.printable:
-                # copy printable strings (digits, letters, punctuation, whitespace)
-                out += i
-            else:  # nonprintable ASCII.
-                out += "\\{0x%02x}" % ord(i)  # print value in hex so it looks like: \{0x02}
-
-        # We could strip whitespace, but we don't want to strip
-        # whitespace from the strings that we are saying that we are
-        # searching for.
+        return sanitizeString(instring, escape)
 
-        return out
+    def run(self, exe, timeout=5, stdindata=None, deductTimeout=0, deductSegfault=0, quiet=False, workToDoWhileRunning=None, cache=False, capture=None):
+        """Runs exe for up to timeout seconds. stdindata is sent to the process on stdin. deductTimeout points are deducted if the process does not finish before the timeout. deductSegfault points are deducted if the program segfaults. Set cache=True for build commands (e.g., make) whose results can be reused when the same files are built again (see buildCacheDir). capture sets how much of the output is kept for the report, e.g., { 'headLines': 20, 'tailLines': 5 } (see captureLimitBytes)."""
+        cmd = Command(exe, capture=capture)
+        if cache and buildCacheDir is not None:
+            cmd.runCached(self, BuildCache(buildCacheDir), timeout=timeout, stdindata=stdindata, workToDoWhileRunning=workToDoWhileRunning)
+        else:
+            cmd.run(self, timeout=timeout, stdindata=stdindata, workToDoWhileRunning=workToDoWhileRunning)
+        return self.log_runResult(cmd, timeout=timeout, deductTimeout=deductTimeout, deductSegfault=deductSegfault, quiet=quiet)
+
+    async def run_async(self, exe, timeout=5, stdindata=None, deductTimeout=0, deductSegfault=0, quiet=False, capture=None):
+        """Same as run(), but it is a coroutine so other programs can run at the same time. Use gather() to run several of them and to keep the autograder log in a predictable order."""
+        cmd = Command(exe, capture=capture)
+        await cmd.run_async(self, timeout=timeout, stdindata=stdindata)
+        return self.log_runResult(cmd, timeout=timeout, deductTimeout=deductTimeout, deductSegfault=deductSegfault, quiet=quiet)
+
+    def openOutputArtifact(self, cmd, stream):
+        """Opens a compressed file for the complete stream ("stdout" or "stderr") of cmd, a Command. Returns None if outputArtifacts is None."""
+        global outputArtifacts
+        if outputArtifacts is None:
+            return None
+        with self.logLock:
+            if self.outputDir is None:
+                self.outputDir = tempfile.mkdtemp(prefix="autograder-output-")
+            self.outputArtifactCount += 1
+            name = "%03d-%s.%s" % (self.outputArtifactCount, re.sub(r"[^\w.-]", "_", os.path.basename(cmd.cmdShort)), stream)
 
-    def run(self, exe, timeout=5, stdindata=None, deductTimeout=0, deductSegfault=0, quiet=False, workToDoWhileRunning=None):
-        """Runs exe for up to timeout seconds. stdindata is sent to the process on stdin. deductTimeout points are deducted if the process does not finish before the timeout. deductSegfault points are deducted if the program segfaults."""
-        cmd = Command(exe)
-        (didRun, tooSlow, retcode, stdoutdata, stderrdata) = cmd.run(self, timeout=timeout, stdindata=stdindata, workToDoWhileRunning=workToDoWhileRunning)
+        if outputArtifacts == "zstd":
+            try:
+                import zstandard
+            except ImportError:
+                print("Install the zstandard module to save output with zstd. Using gzip instead.")
+                outputArtifacts = "gzip"
+        if outputArtifacts == "zstd":
+            name += ".zst"
+            f = zstandard.ZstdCompressor().stream_writer(open(os.path.join(self.outputDir, name), "wb"))
+        else:
+            name += ".gz"
+            # Programs can write a lot of output before they time
+            # out, so compress quickly rather than well.
+            f = gzip.open(os.path.join(self.outputDir, name), "wb", compresslevel=1)
+        # cleanup() moves the files next to AUTOGRADE.html.
+        setattr(cmd, stream + "Artifact", "AUTOGRADE.output/" + name)
+        return f
+
+    def log_runResult(self, cmd, timeout=5, deductTimeout=0, deductSegfault=0, quiet=False):
+        """Logs the output of a Command that has finished and deducts points for timeouts and segfaults. Returns (didRun, tooSlow, retcode, stdoutdata, stderrdata)."""
+        (didRun, tooSlow, retcode, stdoutdata, stderrdata) = (cmd.didRun, cmd.tooSlow, cmd.retcode, cmd.stdoutdata, cmd.stderrdata)
         if quiet:
             return (didRun, tooSlow, retcode, stdoutdata, stderrdata)
 
@@ -875,187 +2779,865 @@ class autograder():
             self.log_addEntry("%s: Program exited due to a signal (segfault?)" % cmd.cmdShort, deductSegfault)
 
         if len(stdoutdata) == 0 and len(stderrdata) == 0:
-            self.log_addEntry("%s: stdout and stderr were empty." % cmd.cmdShort)
+            self.log_entry('output', message="%s: stdout and stderr were empty." % cmd.cmdShort, cmd=cmd.cmd)
         elif len(stdoutdata) > 0 and len(stderrdata) > 0:
-            msg = "%s: stdout:" % cmd.cmdShort
-            msg += "<div class='preformatcode'><pre>%s</pre></div>" % self.sanitize_string(stdoutdata)
-            self.log_generic(msg, deductPoints=0, needSanitize=False)
-            msg = "%s: stderr:" % cmd.cmdShort
-            msg += "<div class='preformatcode'><pre>%s</pre></div>" % self.sanitize_string(stderrdata)
-            self.log_generic(msg, deductPoints=0, needSanitize=False)
-
+            self.log_entry('output', message="%s: stdout:" % cmd.cmdShort, pre=stdoutdata, artifact=cmd.stdoutArtifact, cmd=cmd.cmd, stream='stdout')
+            self.log_entry('output', message="%s: stderr:" % cmd.cmdShort, pre=stderrdata, artifact=cmd.stderrArtifact, cmd=cmd.cmd, stream='stderr')
         elif len(stdoutdata) == 0 and len(stderrdata) > 0:
-            msg = "%s: stdout was empty, stderr was:" % cmd.cmdShort
-            msg += "<div class='preformatcode'><pre>%s</pre></div>" % self.sanitize_string(stderrdata)
-            self.log_generic(msg, deductPoints=0, needSanitize=False)
+            self.log_entry('output', message="%s: stdout was empty, stderr was:" % cmd.cmdShort, pre=stderrdata, artifact=cmd.stderrArtifact, cmd=cmd.cmd, stream='stderr')
         else:
-            msg = "%s: stderr was empty, stdout was:" % cmd.cmdShort
-            msg += "<div class='preformatcode'><pre>%s</pre></div>" % self.sanitize_string(stdoutdata)
-            self.log_generic(msg, deductPoints=0, needSanitize=False)
+            self.log_entry('output', message="%s: stderr was empty, stdout was:" % cmd.cmdShort, pre=stdoutdata, artifact=cmd.stdoutArtifact, cmd=cmd.cmd, stream='stdout')
 
         return (didRun, tooSlow, retcode, stdoutdata, stderrdata)
 
 
 
-    def run_expectExitCode(self, exe, stdindata=None, timeout=5, expectExitCode = 0, deductTimeout=0, deductSegfault=0, deductWrongExit=0, workToDoWhileRunning=None, quiet=False):
+    def session(self, exe, timeout=5):
+        """Starts exe and returns a Session for interacting with it while it runs. The program is killed if it runs longer than timeout seconds. Call close() on the session (or use it in a "with" statement) when finished."""
+        return Session(self, exe, timeout=timeout)
+
+
+    def run_expectExitCode(self, exe, stdindata=None, timeout=5, expectExitCode = 0, deductTimeout=0, deductSegfault=0, deductWrongExit=0, workToDoWhileRunning=None, quiet=False, cache=False, capture=None):
         """Acts the same as run() but also deducts points if return code doesn't match expectRetExitCode."""
-        (didRun, tooSlow, retcode, stdoutdata, stderrdata) = self.run(exe, stdindata=stdindata, deductTimeout=deductTimeout, deductSegfault=deductSegfault, timeout=timeout, quiet=quiet, workToDoWhileRunning=workToDoWhileRunning)
+        result = self.run(exe, stdindata=stdindata, deductTimeout=deductTimeout, deductSegfault=deductSegfault, timeout=timeout, quiet=quiet, workToDoWhileRunning=workToDoWhileRunning, cache=cache, capture=capture)
+        self.check_exitCode(exe, result[2], expectExitCode, deductSegfault, deductWrongExit)
+        return result
+
+    async def run_expectExitCode_async(self, exe, stdindata=None, timeout=5, expectExitCode = 0, deductTimeout=0, deductSegfault=0, deductWrongExit=0, quiet=False, capture=None):
+        """Same as run_expectExitCode(), but it is a coroutine (see run_async())."""
+        result = await self.run_async(exe, stdindata=stdindata, deductTimeout=deductTimeout, deductSegfault=deductSegfault, timeout=timeout, quiet=quiet, capture=capture)
+        self.check_exitCode(exe, result[2], expectExitCode, deductSegfault, deductWrongExit)
+        return result
+
+    def check_exitCode(self, exe, retcode, expectExitCode, deductSegfault=0, deductWrongExit=0):
+        """Deducts points if retcode (returned by exe) doesn't match expectExitCode."""
         # Don't deduct points for wrong exit code if we are already deducting points for segfault.
         if retcode < 0 and deductSegfault != 0 and deductWrongExit != 0:
             self.log_addEntry("%s: Won't deduct points for wrong exit code when we already deducted points for abnormal program exit." % exe[0])
             deductWrongExit = 0
 
         if retcode != expectExitCode:
-            self.log_addEntry("%s: Expecting exit code %d but found %d" %
-                              (exe[0], expectExitCode, retcode), deductWrongExit)
+            self.log_check("check_exitCode", False, "%s: Expecting exit code %d but found %d" %
+                           (exe[0], expectExitCode, retcode), deductWrongExit, cmd=exe)
         else:
-            self.log_addEntry("%s: Program exited as expected (with exit code %d)" %
-                              (exe[0],expectExitCode))
-
-        return (didRun, tooSlow, retcode, stdoutdata, stderrdata)
+            self.log_check("check_exitCode", True, "%s: Program exited as expected (with exit code %d)" %
+                           (exe[0],expectExitCode), cmd=exe)
 
     def run_expectNotExitCode(self, exe, expectNotExitCode = 0, timeout=1, stdindata=None, deductTimeout=0, deductSegfault=0, deductWrongExit=0):
         """Acts the same as run() but also deducts points if return code matches expectNotExitCode. If you are running a program that should produce a non-zero exit code, set expectNotExitCode=0."""
-        (didRun, tooSlow, retcode, stdoutdata, stderrdata) = self.run(exe, timeout, stdindata, deductTimeout, deductSegfault)
+        result = self.run(exe, timeout, stdindata, deductTimeout, deductSegfault)
+        self.check_notExitCode(exe, result[2], expectNotExitCode, deductSegfault, deductWrongExit)
+        return result
+
+    async def run_expectNotExitCode_async(self, exe, expectNotExitCode = 0, timeout=1, stdindata=None, deductTimeout=0, deductSegfault=0, deductWrongExit=0):
+        """Same as run_expectNotExitCode(), but it is a coroutine (see run_async())."""
+        result = await self.run_async(exe, timeout, stdindata, deductTimeout, deductSegfault)
+        self.check_notExitCode(exe, result[2], expectNotExitCode, deductSegfault, deductWrongExit)
+        return result
+
+    def check_notExitCode(self, exe, retcode, expectNotExitCode, deductSegfault=0, deductWrongExit=0):
+        """Deducts points if retcode (returned by exe) matches expectNotExitCode."""
         if retcode < 0 and deductSegfault != 0 and deductWrongExit != 0:
             self.log_addEntry("%s: Won't deduct points for wrong exit code when we already deducted points for abnormal program exit." % exe[0])
             deductWrongExit = 0
         if retcode == expectNotExitCode:
-            self.log_addEntry("%s: Expecting an exit code that is not %d but found %d" % (exe[0], expectNotExitCode, retcode), deductWrongExit)
+            self.log_check("check_notExitCode", False, "%s: Expecting an exit code that is not %d but found %d" % (exe[0], expectNotExitCode, retcode), deductWrongExit, cmd=exe)
         else:
-            self.log_addEntry("%s: Program exited as we expected (with any exit code except %d)" % (exe[0], expectNotExitCode))
-        return (didRun, tooSlow, retcode, stdoutdata, stderrdata)
+            self.log_check("check_notExitCode", True, "%s: Program exited as we expected (with any exit code except %d)" % (exe[0], expectNotExitCode), cmd=exe)
+
+
+    def gather(self, *coroutines, jobs=None):
+        """Runs coroutines (e.g., from run_async()) at the same time, at most jobs of them at once (default: number of CPUs). Everything each coroutine logs is held back and then written to the autograder log in the order the coroutines were passed in, so the log doesn't depend on which program finished first. Returns a list of their results.
+
+        Call gather() from regular code; it runs the asyncio event loop until all coroutines are done. Use gather_async() from inside a coroutine."""
+        return asyncio.run(self.gather_async(*coroutines, jobs=jobs))
+
+    async def gather_async(self, *coroutines, jobs=None):
+        """Same as gather() but is a coroutine itself."""
+        if jobs is None:
+            jobs = os.cpu_count() or 1
+        limit = asyncio.Semaphore(jobs)
+        buffers = [ [] for c in coroutines ]
+
+        async def runBuffered(coroutine, buffer):
+            # This runs as its own task, so setting the buffer here
+            # only affects this coroutine.
+            logBuffer.set(buffer)
+            async with limit:
+                return await coroutine
 
+        try:
+            return await asyncio.gather(*[ runBuffered(c, b) for (c, b) in zip(coroutines, buffers) ])
+        finally:
+            for buffer in buffers:
+                self.log_flushBuffer(buffer)
+
+
+    def run_tests(self, tests, jobs=None):
+        """Runs a table of tests (a list of TestCase objects) at the same time, at most jobs of them at once (default: number of CPUs). Each test runs in its own copy of the working directory. The log entries of each test are written in the order of the table. Returns a list with True for each test that passed."""
+        return self.gather(*[ self.run_test_async(t, i) for (i, t) in enumerate(tests) ], jobs=jobs)
+
+    async def run_test_async(self, test, number=0):
+        """Runs a single TestCase in a copy of the working directory and checks its results. Returns True if all checks passed."""
+        self.log_addEntry("=== Test %d: %s" % (number+1, test.name))
+
+        # Give this test a copy of the working directory so that
+        # tests running at the same time can't see each other's files.
+        # The working directory belongs to the programs being graded,
+        # so copy it (and write the test's files) as their user.
+        testDir = os.path.join(self.tempdir, "test-%d" % number)
+        try:
+            asSandboxUser(makeRunDir, testDir, test.files, self.workingDirectory)
+        except OSError as e:
+            self.log_addEntry("Test %d failed: %s (couldn't set up the directory to run it in: %s)" % (number+1, test.name, e), test.points)
+            return False
+
+        cmd = Command(test.args, cwd=testDir)
+        await cmd.run_async(self, timeout=test.timeout, stdindata=test.stdin)
+        (didRun, tooSlow, retcode, stdoutdata, stderrdata) = self.log_runResult(cmd, timeout=test.timeout)
+        # Not testDir: checkScratchBudget() may have moved it.
+        shutil.rmtree(os.path.join(self.tempdir, "test-%d" % number), ignore_errors=True)
+
+        passed = didRun and not tooSlow
+        if test.expectExitCode is not None and didRun and not tooSlow:
+            self.check_exitCode(test.args, retcode, test.expectExitCode)
+            passed = passed and retcode == test.expectExitCode
+        passed = all(self.mustContainAll(stdoutdata, test.contains)) and passed
+        for needle in test.notContains:
+            passed = self.stringMustNotContain(stdoutdata, needle, 0) and passed
+        passed = all(self.mustContainAll(stdoutdata, test.regex, regex=True)) and passed
+
+        if passed:
+            self.log_addEntry("Test %d passed: %s" % (number+1, test.name))
+        else:
+            self.log_addEntry("Test %d failed: %s" % (number+1, test.name), test.points)
+        return passed
+
+
+    def _inputDir(self, name, files, source=None):
+        """Creates the directory name in the temporary directory (a copy of source without its symlinks, if set) for running a program in, with files (filename -> contents) in it. Returns its path. Raises OSError if that fails."""
+        path = os.path.join(self.tempdir, name)
+        # As the user that runs the programs being graded: they can
+        # write to tempdir and source.
+        asSandboxUser(makeRunDir, path, files, source)
+        return path
+
+    def _privatePath(self, name):
+        """Returns the path for name in privateDir, creating privateDir if needed."""
+        with self.logLock:
+            if self.privateDir is None:
+                self.privateDir = tempfile.mkdtemp(prefix="autograder-private-")
+        return os.path.join(self.privateDir, name)
+
+    def _runToFile(self, cmd, name, timeout, stdindata):
+        """Runs cmd (a Command) and writes its stdout, up to outputArtifactLimitBytes, to the file name in privateDir. Returns (path of the file, True if stdout was longer than that)."""
+        path = self._privatePath(name)
+        written = 0
+        with open(path, "xb") as f:
+            def write(data):
+                nonlocal written
+                if written < outputArtifactLimitBytes:
+                    f.write(data[:outputArtifactLimitBytes - written])
+                written += len(data)
+            cmd.run(self, timeout=timeout, stdindata=stdindata, onOutput=write)
+        return (path, written > outputArtifactLimitBytes)
+
+    def reference(self, exe, args=[], stdindata=None, files={}, timeout=10):
+        """Runs the reference solution exe with args, stdindata and files (filename -> contents) in its directory, once per input (see referenceCacheDir), and returns its result or None if it can't be compared with."""
+        # The result has 'retcode', 'stdout' and 'stderr' (abbreviated like
+        # for run()), 'stdoutFile' (all of stdout), 'filesDir' (the files the
+        # reference solution created or changed) and 'cached'. None means it
+        # couldn't be run, didn't finish in time or printed more than
+        # outputArtifactLimitBytes.
+        if os.sep in exe[0]:
+            exe = [ os.path.abspath(exe[0]) ] + exe[1:]
+        self.runDirCount += 1
+        name = "reference-%d" % self.runDirCount
+        workDir = self._inputDir(name, files)
+        cache = ReferenceCache(referenceCacheDir) if referenceCacheDir is not None else None
+        if cache is not None:
+            try:
+                key = cache.key(exe + args, stdindata, workDir)
+            except OSError as e:
+                shutil.rmtree(workDir)
+                self.log_addEntry("%s: Can't read the reference solution (%s); can't compare with it." % (exe[0], e))
+                return None
+            entry = cache.get(key)
+            if entry is not None:
+                shutil.rmtree(workDir)
+                return { 'retcode': entry['retcode'], 'stdout': entry['stdout'], 'stderr': entry['stderr'],
+                         'stdoutFile': os.path.join(cache.entryDir(key), "stdout"),
+                         'filesDir': os.path.join(cache.entryDir(key), "files"), 'cached': True }
+            before = cache.snapshot(workDir)
+
+        # The report is about the submission, so only show how the
+        # reference solution ran if something went wrong.
+        cmd = Command(exe + args, cwd=workDir)
+        token = logBuffer.set([])
+        try:
+            (stdoutPath, truncated) = self._runToFile(cmd, name + ".stdout", timeout, stdindata)
+        finally:
+            buffer = logBuffer.get()
+            logBuffer.reset(token)
+        # Not workDir: checkScratchBudget() may have moved it.
+        workDir = os.path.join(self.tempdir, name)
+        if not cmd.didRun or cmd.tooSlow:
+            self.log_flushBuffer(buffer)
+            self.log_addEntry("%s: The reference solution didn't finish; can't compare with it." % exe[0])
+            return None
+        if truncated:
+            self.log_addEntry("%s: The reference solution printed more than %s; can't compare with it." % (exe[0], self.humanSize(outputArtifactLimitBytes)))
+            return None
+
+        if cache is not None:
+            cache.put(key, cmd, before, workDir, stdoutFile=stdoutPath)
+            entry = cache.get(key)
+            if entry is not None:
+                shutil.rmtree(workDir)
+                os.remove(stdoutPath)
+                return { 'retcode': entry['retcode'], 'stdout': entry['stdout'], 'stderr': entry['stderr'],
+                         'stdoutFile': os.path.join(cache.entryDir(key), "stdout"),
+                         'filesDir': os.path.join(cache.entryDir(key), "files"), 'cached': False }
+        # Without a cache, keep the files until cleanup() removes them,
+        # out of reach of the programs that are compared with them.
+        filesDir = self._privatePath(name)
+        shutil.move(workDir, filesDir)
+        return { 'retcode': cmd.retcode, 'stdout': cmd.stdoutdata, 'stderr': cmd.stderrdata,
+                 'stdoutFile': stdoutPath, 'filesDir': filesDir, 'cached': False }
+
+    def expect_same_as_reference(self, exe, reference, args=[], stdindata=None, files={}, outputFiles=[], mode="exact", deductPoints=0, deductWrongExit=0, deductTimeout=None, timeout=5, referenceTimeout=10):
+        """Checks that exe, run in a copy of the working directory, exits with the same exit code and writes the same stdout and outputFiles as the reference solution given the same input; returns True if it does."""
+        # A different exit code deducts deductWrongExit, stdout and each of
+        # outputFiles that doesn't match (see expect_output_matches() for mode)
+        # deduct deductPoints. A timeout deducts deductTimeout (default:
+        # deductPoints) and nothing is compared.
+        ref = self.reference(reference, args, stdindata, files, timeout=referenceTimeout)
+        if ref is None:
+            return False
+        if deductTimeout is None:
+            deductTimeout = deductPoints
+
+        self.runDirCount += 1
+        name = "differential-%d" % self.runDirCount
+        try:
+            testDir = self._inputDir(name, files, source=self.workingDirectory)
+        except OSError as e:
+            self.log_check("expect_same_as_reference", False, "%s: Couldn't set up the directory to run it in: %s" % (exe[0], e), deductPoints, cmd=exe)
+            return False
+        cmd = Command(exe + args, cwd=testDir)
+        (stdoutPath, truncated) = self._runToFile(cmd, name + ".stdout", timeout, stdindata)
+        (didRun, tooSlow, retcode, stdoutdata, stderrdata) = self.log_runResult(cmd, timeout=timeout, deductTimeout=deductTimeout)
+        # Not testDir: checkScratchBudget() may have moved it.
+        testDir = os.path.join(self.tempdir, name)
+
+        passed = didRun and not tooSlow
+        if passed:
+            self.check_exitCode(exe, retcode, ref['retcode'], deductWrongExit=deductWrongExit)
+            passed = retcode == ref['retcode']
+            if truncated:
+                self.log_check("expect_output_matches", False, "'%s: stdout' is longer than %s; not comparing it." % (exe[0], self.humanSize(outputArtifactLimitBytes)), deductPoints, filename="%s: stdout" % exe[0], mode=mode)
+                passed = False
+            else:
+                passed = self.expect_output_matches(stdoutPath, ref['stdoutFile'], mode, deductPoints, name="%s: stdout" % exe[0]) and passed
+            for filename in outputFiles:
+                expected = os.path.join(ref['filesDir'], filename)
+                if not os.path.exists(expected):
+                    self.log_addEntry("The reference solution didn't create '%s'; not comparing it." % filename)
+                    continue
+                # The program could have made filename a symlink to a
+                # file it can't read itself; don't show that in the diff.
+                actual = openRegularFile(testDir, filename)
+                if actual is None:
+                    self.log_check("expect_output_matches", False, "Expected output in '%s' but the file is MISSING (or isn't a regular file)." % filename, deductPoints, filename=filename, mode=mode)
+                    passed = False
+                    continue
+                with actual:
+                    passed = self.expect_output_matches(actual, expected, mode, deductPoints, name=filename) and passed
+
+        shutil.rmtree(testDir, ignore_errors=True)
+        os.remove(stdoutPath)
+        return passed
+
+    def _measure(self, exe, stdindata, repeats, warmup, timeout):
+        """Runs exe warmup+repeats times and returns robustStats() of the last repeats runs (and whether their peak memory came from a cgroup), or None if a run failed."""
+        samples = { 'wallTime': [], 'cpuTime': [], 'maxRss': [] }
+        memoryFromCgroup = True
+        for i in range(warmup + repeats):
+            # Don't fill the log with every run; only show a run that
+            # failed.
+            token = logBuffer.set([])
+            try:
+                cmd = Command(exe)
+                cmd.run(self, timeout=timeout, stdindata=stdindata)
+            finally:
+                buffer = logBuffer.get()
+                logBuffer.reset(token)
+            if not cmd.didRun or cmd.tooSlow or cmd.retcode != 0 or cmd.usage is None:
+                self.log_flushBuffer(buffer)
+                self.log_runResult(cmd, timeout=timeout)
+                return None
+            if i < warmup:
+                continue
+            samples['wallTime'].append(cmd.elapsedTime)
+            samples['cpuTime'].append(cmd.usage.get('cgroupCpuTime', cmd.usage['userTime'] + cmd.usage['systemTime']))
+            samples['maxRss'].append(cmd.usage.get('cgroupMemoryPeak', cmd.usage['maxRss']))
+            memoryFromCgroup = memoryFromCgroup and 'cgroupMemoryPeak' in cmd.usage
+        result = { metric: robustStats(values) for (metric, values) in samples.items() }
+        result['memoryFromCgroup'] = memoryFromCgroup
+        return result
+
+    def benchmark(self, exe, inputs=[None], repeats=5, warmup=1, reference=None, deductSlow=[(1.5, 5), (3, 10)], metric="cpuTime", timeout=10):
+        """Measures the wall time, CPU time and peak memory of exe on each of inputs, adds a table to the report and deducts points if it is much slower than the reference solution (see README.md)."""
+        # Each of inputs is None, a string sent to stdin or a list of extra
+        # arguments. Returns { 'inputs': [...], 'ratio': ratio or None }.
+        maxDeduction = max([ pts for (ratio, pts) in deductSlow ], default=0)
+        results = []
+        for stdindata in inputs:
+            args = []
+            if isinstance(stdindata, list):
+                (args, stdindata) = (stdindata, None)
+            if stdindata is None and not args:
+                label = "(no input)"
+            elif args:
+                label = " ".join(args)
+            else:
+                label = "stdin: " + stdindata.splitlines()[0][:20] if stdindata else "stdin: (empty)"
+
+            student = self._measure(exe + args, stdindata, repeats, warmup, timeout)
+            if student is None:
+                self.log_check("benchmark", False, "%s: Couldn't measure the speed of the program on %s because it didn't run successfully." % (exe[0], label), maxDeduction, cmd=exe)
+                return { 'inputs': results, 'ratio': None }
+            if reference is not None and metric == "maxRss" and not student['memoryFromCgroup']:
+                # Without a cgroup, the peak memory of a run is mostly
+                # the autograder's.
+                self.log_addEntry("%s: Peak memory can't be measured because commands don't run in a cgroup; not comparing it with the reference solution." % exe[0])
+                reference = None
+
+            ref = None
+            if reference is not None:
+                refPath = shutil.which(reference[0]) or reference[0]
+                try:
+                    refHash = fileHash(refPath, "sha256")
+                except OSError as e:
+                    self.log_addEntry("%s: Can't read the reference solution (%s); not comparing speed." % (reference[0], e))
+                    reference = None
+            if reference is not None:
+                key = hashlib.sha256(json.dumps([ reference + args, stdindata, repeats, warmup,
+                                                  refHash, machineDescription() ]).encode("utf-8")).hexdigest()
+                ref = loadBenchmarkProfile(key)
+                if ref is None:
+                    ref = self._measure(reference + args, stdindata, repeats, warmup, timeout)
+                    if ref is None:
+                        self.log_addEntry("%s: The reference solution failed on %s; not comparing speed." % (reference[0], label))
+                        reference = None
+                    else:
+                        saveBenchmarkProfile(key, ref)
+
+            entry = { 'input': label, 'student': student, 'reference': ref, 'ratio': None }
+            if ref is not None:
+                # Very short runs are reported as 0 CPU seconds.
+                entry['ratio'] = student[metric]['median'] / max(ref[metric]['median'], .001)
+            results.append(entry)
+
+        self.log_entry('benchmark', message="%s: Speed over %d runs of each input (after %d warm-up runs):" % (exe[0], repeats, warmup),
+                       pre=self.benchmarkTable(results, metric), cmd=exe, results=results)
+
+        if reference is None:
+            return { 'inputs': results, 'ratio': None }
+        ratio = math.exp(sum(math.log(max(e['ratio'], 1e-9)) for e in results) / len(results))
+        deduction = max([ pts for (limit, pts) in deductSlow if ratio > limit ], default=0)
+        self.log_check("benchmark", deduction == 0, "%s: %s was %.2f times that of the reference solution." % (exe[0], metric, ratio), deduction, cmd=exe, ratio=ratio)
+        return { 'inputs': results, 'ratio': ratio }
+
+    def benchmarkTable(self, results, metric="cpuTime"):
+        """Formats the results of benchmark() as a text table."""
+        def show(stats):
+            if metric == "maxRss":
+                return self.humanSize(stats[metric]['median'])
+            return "%.3fs" % stats[metric]['median']
+        rows = [ ("Input", "Wall time", "CPU time", "Peak memory", "Reference %s" % metric, "Ratio") ]
+        unreliable = False
+        for e in results:
+            (st, ref) = (e['student'], e['reference'])
+            memory = self.humanSize(st['maxRss']['median'])
+            if not st.get('memoryFromCgroup', False):
+                memory += "*"
+                unreliable = True
+            rows.append((e['input'],
+                         "%.3fs (%.3f-%.3f)" % (st['wallTime']['median'], st['wallTime']['min'], st['wallTime']['max']),
+                         "%.3fs \u00b1%.3f" % (st['cpuTime']['median'], st['cpuTime']['iqr']/2),
+                         memory,
+                         show(ref) if ref else "-",
+                         "%.2f" % e['ratio'] if e['ratio'] is not None else "-"))
+        widths = [ max(len(row[i]) for row in rows) for i in range(len(rows[0])) ]
+        table = "\n".join("  ".join(col.ljust(w) for (col, w) in zip(row, widths)).rstrip() for row in rows)
+        if unreliable:
+            table += "\n* Includes the autograder's own memory because commands didn't run in a cgroup."
+        return table
 
     def expect_debugInfo(self, exe, deductNoDebug=0):
         cmd = subprocess.Popen("/usr/bin/readelf --debug-dump=info " + exe,
                                shell=True, stdout=subprocess.PIPE)
         (stdoutdata, stderrdata)  = cmd.communicate()
         if len(stdoutdata) < 10:
-            self.log_addEntry("'" + exe + "' does not contain debugging information.", deductNoDebug)
+            self.log_check("expect_debugInfo", False, "'" + exe + "' does not contain debugging information.", deductNoDebug, filename=exe)
         else:
-	        self.log_addEntry("'" + exe + "' contains debugging information.", 0)
+            self.log_check("expect_debugInfo", True, "'" + exe + "' contains debugging information.", filename=exe)
 
     def expect_md5(self, filename, expectMd5, deductMissingFile=0, deductWrongMd5=0):
         if not os.path.exists(filename):
-            self.log_addEntry("md5sum: "+filename+" should have hash " + expectMd5 + " but it is MISSING.", deductMissingFile)
+            self.log_check("expect_md5", False, "md5sum: "+filename+" should have hash " + expectMd5 + " but it is MISSING.", deductMissingFile, filename=filename)
             return False
 
-        # Read file in block by block so we don't have to read the
-        # whole thing at once (this approach allows it to process
-        # large files more easily)
-        # http://joelverhagen.com/blog/2011/02/md5-hash-of-file-in-python/
+        # Files that haven't changed since they were last hashed (e.g.,
+        # reference data checked for every submission) aren't read
+        # again, see fileHash().
         try:
-            with open(filename, 'rb') as fh:
-                m = hashlib.md5()
-                while True:
-                    data = fh.read(8192)
-                    if not data:
-                        break
-                    m.update(data)
-                filehash = m.hexdigest()
+            filehash = fileHash(filename, "md5")
 
-                filesize = "(size: " + self.humanSize(os.stat(filename).st_size) + ")"
-                if filehash != expectMd5:
-                    self.log_addEntry("md5sum: "+filename+" "+filesize+" should have hash " + expectMd5 + " but it has hash " + filehash, deductMissingFile)
-                    return False
-                else:
-                    self.log_addEntry("md5sum: "+filename+" "+filesize+" has the correct hash " + expectMd5)
-                    return True
-        except PermissionError:
-            self.log_addEntry("md5sum: "+filename+" could not be read. We should be able to read it and it should have md5sum "+expectMd5, deductMissingFile)
+            filesize = "(size: " + self.humanSize(os.stat(filename).st_size) + ")"
+            if filehash != expectMd5:
+                self.log_check("expect_md5", False, "md5sum: "+filename+" "+filesize+" should have hash " + expectMd5 + " but it has hash " + filehash, deductMissingFile, filename=filename)
+                return False
+            else:
+                self.log_check("expect_md5", True, "md5sum: "+filename+" "+filesize+" has the correct hash " + expectMd5, filename=filename)
+                return True
+        except OSError:
+            self.log_check("expect_md5", False, "md5sum: "+filename+" could not be read. We should be able to read it and it should have md5sum "+expectMd5, deductMissingFile, filename=filename)
             return False
 
-    def file_must_contain(self, filename, string, deductPoints=0):
-        """The file "filename" should contain the string "string". If it doesn't, deduct points."""
-
-        with open(filename, "r") as myfile:
-            data = myfile.read()
-            if string in data:
-                msg = "File '%s' correctly contains:" % self.sanitize_string(filename)
-                msg += "<div class='preformatcode'><pre>%s</pre></div>" % self.sanitize_string(string)
-                self.log_generic(msg, deductPoints=0, needSanitize=False)
+    def _expandFilenames(self, filenames):
+        """Returns the files matching filenames: a filename, glob pattern or a list of them. A name without matches is kept so that it can be reported as missing."""
+        if isinstance(filenames, str):
+            filenames = [ filenames ]
+        files = []
+        for name in filenames:
+            matches = sorted(glob.glob(name))
+            if not matches and not glob.has_magic(name):
+                matches = [ name ]
+            for f in matches:
+                if f not in files:
+                    files.append(f)
+        return files
+
+    def _searchFiles(self, kind, filenames, needles, deductPoints, search, missingOk=False, anyFile=False):
+        """Searches the raw bytes of each file in filenames (see _expandFilenames()) with search(data, needle) for each of needles; returns the (needle, points) pairs and a dictionary: filename -> list of results."""
+        # needles without points deduct deductPoints. Missing files (unless
+        # missingOk) and unreadable ones are logged as failed checks of kind
+        # and get None instead of results; the key None means that no files
+        # matched. With anyFile (each=False), the caller only deducts for
+        # needles that no file contains, so missing files are searched as if
+        # they were empty and unreadable ones don't deduct points.
+        if isinstance(needles, str):
+            needles = [ needles ]
+        needles = [ (n, deductPoints) if isinstance(n, str) else tuple(n) for n in needles ]
+        results = {}
+        files = self._expandFilenames(filenames)
+        if not files and not missingOk:
+            self.log_check(kind, False, "No files match %s." % filenames, sum(pts for (needle, pts) in needles))
+            results[None] = None
+        for filename in files:
+            try:
+                with open(filename, "rb") as f:
+                    if os.fstat(f.fileno()).st_size == 0:
+                        data = b""  # can't mmap() an empty file
+                    else:
+                        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    try:
+                        results[filename] = [ search(data, needle) for (needle, pts) in needles ]
+                    finally:
+                        if isinstance(data, mmap.mmap):
+                            data.close()
+            except FileNotFoundError:
+                if anyFile:
+                    results[filename] = [ search(b"", needle) for (needle, pts) in needles ]
+                elif not missingOk:
+                    self.log_check(kind, False, "File '%s' is missing." % filename, sum(pts for (needle, pts) in needles), filename=filename)
+                    results[filename] = None
+            except (PermissionError, IsADirectoryError):
+                self.log_check(kind, False, "File '%s' could not be read." % filename, 0 if anyFile else sum(pts for (needle, pts) in needles), filename=filename)
+                results[filename] = None
+        return (needles, results)
+
+    def _logFileSearch(self, kind, needles, results, each, messages):
+        """Logs the results of _searchFiles() for file_must_contain() and file_must_match_regex(); returns True if all checks passed."""
+        # messages are for a needle found in a file, not found in a file,
+        # found in one of the files and not found in any of them.
+        ok = all(found is not None for found in results.values())
+        if each:
+            for (filename, found) in results.items():
+                for ((needle, pts), f) in zip(needles, found or []):
+                    if f:
+                        self.log_check(kind, True, messages[0] % filename, pre=needle, filename=filename)
+                    else:
+                        self.log_check(kind, False, messages[1] % filename, pts, pre=needle, filename=filename)
+                        ok = False
+            return ok
+        if None in results:
+            return False  # no files matched; that was already deducted
+        # Only whether some file contains each needle matters here.
+        ok = True
+        names = ", ".join(results)
+        for (i, (needle, pts)) in enumerate(needles):
+            if any(found and found[i] for found in results.values()):
+                self.log_check(kind, True, messages[2] % names, pre=needle)
             else:
-                msg = "File '%s' does not contain:" % self.sanitize_string(filename)
-                msg += "<div class='preformatcode'><pre>%s</pre></div>" % self.sanitize_string(string)
-                self.log_generic(msg, deductPoints=deductPoints, needSanitize=False)
+                self.log_check(kind, False, messages[3] % names, pts, pre=needle)
+                ok = False
+        return ok
+
+    def file_must_contain(self, filenames, strings, deductPoints=0, each=True, encoding="utf-8"):
+        """Checks that each of the files in filenames (a filename, glob or list of them) contains each of strings, or with each=False that one of them does, and deducts points for each string that is missing."""
+        # strings is a string, a list of them or a list of (string, points)
+        # pairs. Files are searched as bytes, so files of any size and with
+        # invalid characters can be checked.
+        search = lambda data, needle: data.find(needle.encode(encoding)) != -1
+        (needles, results) = self._searchFiles("file_must_contain", filenames, strings, deductPoints, search, anyFile=not each)
+        return self._logFileSearch("file_must_contain", needles, results, each,
+                                   ("File '%s' correctly contains:",
+                                    "File '%s' does not contain:",
+                                    "One of the files %s correctly contains:",
+                                    "None of the files %s contain:"))
+
+    def file_must_not_contain(self, filenames, strings, deductPoints=0, encoding="utf-8"):
+        """Checks that none of the files in filenames (see file_must_contain()) contain any of strings and deducts points for each string in each file that does."""
+        # Missing files don't contain anything.
+        search = lambda data, needle: data.find(needle.encode(encoding)) != -1
+        (needles, results) = self._searchFiles("file_must_not_contain", filenames, strings, deductPoints, search, missingOk=True)
+        ok = all(found is not None for found in results.values())
+        for (filename, found) in results.items():
+            for ((needle, pts), f) in zip(needles, found or []):
+                if f:
+                    self.log_check("file_must_not_contain", False, "File '%s' contains the following string that it should NOT contain:" % filename, pts, pre=needle, filename=filename)
+                    ok = False
+                else:
+                    self.log_check("file_must_not_contain", True, "File '%s' correctly lacks:" % filename, pre=needle, filename=filename)
+        return ok
+
+    def file_must_match_regex(self, filenames, patterns, deductPoints=0, each=True, encoding="utf-8", flags=re.MULTILINE):
+        """Same as file_must_contain(), but patterns are regular expressions that are matched against the bytes of the files."""
+        search = lambda data, pattern: re.search(pattern.encode(encoding), data, flags) is not None
+        (needles, results) = self._searchFiles("file_must_match_regex", filenames, patterns, deductPoints, search, anyFile=not each)
+        return self._logFileSearch("file_must_match_regex", needles, results, each,
+                                   ("File '%s' correctly matches the regular expression:",
+                                    "File '%s' does not match the regular expression:",
+                                    "One of the files %s correctly matches the regular expression:",
+                                    "None of the files %s match the regular expression:"))
 
 
     def stringMustContainRegex(self, haystack, needle, pts=0):
-        if re.search(needle, haystack, re.IGNORECASE):
-            self.log_addEntry("Output correctly contained: '" + needle + "' (regex)", 0)
+        return self._logContainsRegex(needle, compileIgnoreCase(needle).search(haystack) is not None, pts)
+
+    def _logContainsRegex(self, needle, found, pts):
+        if found:
+            self.log_check("stringMustContainRegex", True, "Output correctly contained: '" + needle + "' (regex)")
             return True
         else:
-            self.log_addEntry("Output did not contain '" + needle + "' (regex)", pts)
+            self.log_check("stringMustContainRegex", False, "Output did not contain '" + needle + "' (regex)", pts)
             return False
 
     def stringMustContain(self, haystack, needle, pts=0):
         """Search for a string within a string, deduct points if it isn't found."""
-        with self.logLock:
-            self.log("<tr>")
-            self.log_lineNumber()
+        return self._logContains(needle, needle.lower() in haystack.lower(), pts)
 
-            found = False
-            needlelow = needle.lower()
-            haystacklow = haystack.lower()
-            if needlelow not in haystacklow:
-                if abs(pts) > 0:
-                    self.log("<td>%d</td>" % -abs(pts))
-                    self.logPointsTotal -= abs(pts)
-                else:
-                    self.log("<td></td>")
+    def _logContains(self, needle, found, pts):
+        if found:
+            self.log_check("stringMustContain", True, "Correctly found the following string (case insensitive):", pre=needle)
+        else:
+            self.log_check("stringMustContain", False, "Did not find the following string (case insensitive):", pts, pre=needle)
+        return found
 
-                self.log("<td>Did not find the following string (case insensitive):")
+    def mustContainAll(self, haystack, needles, regex=False):
+        """Same as calling stringMustContain() (or stringMustContainRegex() if regex is True) for each needle, but haystack is only converted to lowercase once. needles is a list of (needle, pts) pairs or of needles (pts=0). Returns a list with True for each needle that was found."""
+        results = []
+        if not regex:
+            haystacklow = haystack.lower()
+        for needle in needles:
+            pts = 0
+            if not isinstance(needle, str):
+                (needle, pts) = needle
+            if regex:
+                results.append(self._logContainsRegex(needle, compileIgnoreCase(needle).search(haystack) is not None, pts))
             else:
-                self.log("<td></td>")
-                self.log("<td>Correctly found the following string (case insensitive):")
-                found = True
-
-            self.log_pre(needle)
-            self.log("</td></tr>")
-            return found
+                results.append(self._logContains(needle, needle.lower() in haystacklow, pts))
+        return results
 
     def stringMustNotContain(self, haystack, needle, pts):
         """Search for a string within a string, deduct points if it isn't found."""
-        with self.logLock:
-            self.log("<tr>")
-            self.log_lineNumber()
+        if needle.lower() not in haystack.lower():
+            self.log_check("stringMustNotContain", True, "The string correctly lacked the following string (case insensitive):", pre=needle)
+            return True
+        else:
+            self.log_check("stringMustNotContain", False, "Found the following string that we should NOT find (case insensitive):", pts, pre=needle)
+            return False
 
-            needlelow = needle.lower()
-            haystacklow = haystack.lower()
-            if needlelow not in haystacklow:
-                self.log("<td></td>")
-                self.log("<td>The string correctly lacked the following string (case insensitive):")
-            else:
-                if abs(pts) > 0:
-                    self.log("<td>%d</td>" % -abs(pts))
-                    self.logPointsTotal -= abs(pts)
-                else:
-                    self.log("<td></td>")
-                self.log("<td>Found the following string that we should NOT find (case insensitive):")
+    def _outputLines(self, source):
+        """Yields (line number, line) for each line (as bytes) in source: a filename or a file object."""
+        if isinstance(source, str):
+            with open(source, "rb") as f:
+                yield from enumerate(f, 1)
+            return
+        for (number, line) in enumerate(source, 1):
+            if isinstance(line, str):
+                line = line.encode("utf-8")
+            yield (number, line)
+
+    def _sameFiles(self, filename1, filename2):
+        """Returns True if the two files have exactly the same contents."""
+        if os.path.getsize(filename1) != os.path.getsize(filename2):
+            return False
+        with open(filename1, "rb") as f1, open(filename2, "rb") as f2:
+            while True:
+                chunk = f1.read(1024*1024)
+                if chunk != f2.read(1024*1024):
+                    return False
+                if not chunk:
+                    return True
 
-            self.log_pre(needle)
-            self.log("</td></tr>")
+    def expect_output_matches(self, actual, expected, mode="exact", deductPoints=0, maxDiffs=5, tolerance=1e-6, name=None):
+        """Compares actual (a filename or a file object, e.g., io.StringIO(stdoutdata)) with the file expected using mode (see README.md) and deducts deductPoints if they differ; returns True if they match."""
+        # Neither file is read into memory (except the expected lines in
+        # "lines" mode). The report shows a unified diff excerpt of the first
+        # maxDiffs differences; name is what actual is called there.
+        actualName = name or (actual if isinstance(actual, str) else getattr(actual, "name", "output"))
+        if not isinstance(actualName, str):
+            actualName = "output"
+        if isinstance(actual, str) and not os.path.exists(actual):
+            self.log_check("expect_output_matches", False, "Expected output in '%s' but the file is MISSING." % actualName, deductPoints, filename=actual, mode=mode)
+            return False
+
+        if isinstance(actual, str) and self._sameFiles(actual, expected):
+            (diffs, excerpt) = (0, "")
+        elif mode == "lines":
+            (diffs, excerpt) = self._compareLineSets(actual, expected, maxDiffs)
+        else:
+            (diffs, excerpt) = self._compareLines(actual, expected, mode, maxDiffs, tolerance)
+
+        if diffs == 0:
+            self.log_check("expect_output_matches", True, "'%s' matches the expected output (%s)" % (actualName, mode), filename=actualName, mode=mode)
+            return True
+        if diffs >= maxDiffs:
+            msg = "'%s' does not match the expected output (%s); showing the first %d differences:" % (actualName, mode, diffs)
+        else:
+            msg = "'%s' does not match the expected output (%s); %d differences:" % (actualName, mode, diffs)
+        self.log_check("expect_output_matches", False, msg, deductPoints, pre=excerpt, filename=actualName, mode=mode, differences=diffs)
+        return False
 
-    def profanityCheck(self, filenameGlobs, deductPoints=1):
-        """Checks for profanity in text files. Deducts points if found."""
+    def _compareLines(self, actual, expected, mode, maxDiffs, tolerance):
+        """Compares actual and expected line by line for expect_output_matches(), lining them up like diff so that an extra or missing line counts once. Returns (number of differing lines, diff excerpt)."""
+        def normalize(line):
+            if mode == "exact":
+                return line
+            return line.split()
+
+        def same(a, e):
+            if mode != "numeric":
+                return a == e
+            if len(a) != len(e):
+                return False
+            for (x, y) in zip(a, e):
+                if x == y:
+                    continue
+                try:
+                    if not math.isclose(float(x), float(y), rel_tol=tolerance, abs_tol=tolerance):
+                        return False
+                except ValueError:
+                    return False
+            return True
+
+        # Significant digits that numbers are rounded to for lining up
+        # lines in "numeric" mode.
+        digits = max(1, int(-math.log10(tolerance)) - 1) if 0 < tolerance < 1 else 1
+        def key(line):
+            """What lines are lined up by. In "numeric" mode, numbers are rounded so that close ones (usually) look alike; the rest end up in 'replace' blocks, where same() still accepts them."""
+            words = normalize(line)
+            if mode == "exact":
+                return words
+            if mode != "numeric":
+                return tuple(words)
+            rounded = []
+            for w in words:
+                try:
+                    rounded.append(b"%.*g" % (digits, float(w)))
+                except ValueError:
+                    rounded.append(w)
+            return tuple(rounded)
+
+        def lines(source):
+            for (number, line) in self._outputLines(source):
+                if mode != "exact" and not line.strip():
+                    continue  # blank lines don't matter
+                yield (number, line)
+
+        # Only a window of lines from each file is lined up at a time,
+        # so memory (and SequenceMatcher's work) stays bounded.
+        window = 500
+        def aligned():
+            """Yields ((expected, actual), isSame) with the lines of both files lined up. expected or actual is None for a line that is only in the other file."""
+            expectedLines = lines(expected)
+            actualLines = lines(actual)
+            (eBuf, aBuf) = ([], [])
+            while True:
+                eBuf += itertools.islice(expectedLines, window - len(eBuf))
+                aBuf += itertools.islice(actualLines, window - len(aBuf))
+                if not eBuf and not aBuf:
+                    return
+                # Most lines match where they are; only line up the
+                # lines (which is slow, especially in "numeric" mode
+                # where all numbers look alike) from a difference on.
+                k = 0
+                while k < len(eBuf) and k < len(aBuf) and same(normalize(aBuf[k][1]), normalize(eBuf[k][1])):
+                    yield ((eBuf[k], aBuf[k]), True)
+                    k += 1
+                if k > 0:
+                    (eBuf, aBuf) = (eBuf[k:], aBuf[k:])
+                    continue
+                atEnd = len(eBuf) < window and len(aBuf) < window
+                opcodes = difflib.SequenceMatcher(None, [ key(e[1]) for e in eBuf ], [ key(a[1]) for a in aBuf ], autojunk=False).get_opcodes()
+                # Unless both files are done, stop at the last run of
+                # matching lines: what comes after it might line up
+                # with lines that aren't in the window yet.
+                last = max([ i for (i, op) in enumerate(opcodes) if op[0] == 'equal' ], default=None)
+                if not atEnd and last is not None:
+                    opcodes = opcodes[:last+1]
+                for (tag, i1, i2, j1, j2) in opcodes:
+                    for k in range(max(i2-i1, j2-j1)):
+                        e = eBuf[i1+k] if i1+k < i2 else None
+                        a = aBuf[j1+k] if j1+k < j2 else None
+                        yield ((e, a), e is not None and a is not None and same(normalize(a[1]), normalize(e[1])))
+                (eBuf, aBuf) = (eBuf[opcodes[-1][2]:], aBuf[opcodes[-1][4]:])
+
+        # Lines around the differences are kept in hunks (lists of
+        # (expected, actual) pairs) so we never hold more than a few
+        # lines of matching output.
+        context = 3
+        before = collections.deque(maxlen=context)  # matching lines since the last hunk
+        hunks = []
+        hunk = None
+        run = 0  # matching lines since the last difference
+        diffs = 0
+        for (pair, isSame) in aligned():
+            if hunk is None:
+                if isSame:
+                    before.append(pair)
+                    continue
+                hunk = list(before)
+                hunks.append(hunk)
+            hunk.append(pair)
+            if diffs >= maxDiffs:
+                # Show a few lines after the last difference we count.
+                run += 1
+                if run >= context:
+                    break
+                continue
+            if not isSame:
+                diffs += 1
+                run = 0
+                continue
+            run += 1
+            if run == 2*context:
+                # Far enough from the last difference to start a new hunk later.
+                before.clear()
+                before.extend(hunk[-context:])
+                del hunk[-context:]
+                hunk = None
+
+        excerpt = [ "--- expected", "+++ actual" ]
+        for h in hunks:
+            excerpt += self._diffExcerpt(h)
+        return (diffs, "\n".join(excerpt))
+
+    def _diffExcerpt(self, window):
+        """Returns the lines of a unified diff (without the file names) of the (expected, actual) line pairs in window, with line numbers from the files."""
+        def decode(pair):
+            return pair[1].decode("utf-8", errors="replace").rstrip("\r\n")
+        expectedLines = [ decode(e) for (e, a) in window if e is not None ]
+        actualLines = [ decode(a) for (e, a) in window if a is not None ]
+        eStart = next((e[0] for (e, a) in window if e is not None), 1)
+        aStart = next((a[0] for (e, a) in window if a is not None), 1)
+
+        out = []
+        for line in list(difflib.unified_diff(expectedLines, actualLines, n=3, lineterm=""))[2:]:
+            match = re.match(r"@@ -(\d+)(,\d+)? \+(\d+)(,\d+)? @@", line)
+            if match:
+                line = "@@ -%d%s +%d%s @@" % (int(match.group(1)) + eStart - 1, match.group(2) or "",
+                                              int(match.group(3)) + aStart - 1, match.group(4) or "")
+            out.append(line)
+        return out
+
+    def _compareLineSets(self, actual, expected, maxDiffs):
+        """Compares the lines of actual and expected, in any order, for expect_output_matches(). Returns (number of differences found, excerpt)."""
+        with open(expected, "rb") as f:
+            remaining = collections.Counter(map(bytes.strip, f))
+        unexpected = []
+        for (number, line) in self._outputLines(actual):
+            line = line.strip()
+            if remaining[line] > 0:
+                remaining[line] -= 1
+            else:
+                unexpected.append((number, line))
+                if len(unexpected) >= maxDiffs:
+                    break
+        missing = list((+remaining).elements())[:maxDiffs - len(unexpected)]
+
+        out = []
+        for line in missing:
+            out.append("-" + line.decode("utf-8", errors="replace"))
+        for (number, line) in unexpected:
+            out.append("+%s    (line %d)" % (line.decode("utf-8", errors="replace"), number))
+        return (len(missing) + len(unexpected), "\n".join(out))
+
+    # Words that profanityCheck() looks for.
+    profanityWords = [ "fuck", " shit ", "bitch", "biatch", " cunt", "damn", " ass "]
+
+    def profanityCheck(self, filenameGlobs, deductPoints=1, maxBytes=10*1024*1024):
+        """Checks for profanity in text files. Deducts points if found. Binary files and files larger than maxBytes are skipped."""
         if isinstance(filenameGlobs, str):
             filenameGlobs = [ filenameGlobs ]
+        words = [ w.encode() for w in self.profanityWords ]
 
         profanityCount = 0
         for g in filenameGlobs:
             files = glob.glob(g)
             for f in files:
-                if os.path.exists(f):
-                    with open(f, "r", errors='replace') as fd:
-                        fileContents = fd.read()
-                        lines = fileContents.splitlines()
-                        words = [ "fuck", " shit ", "bitch", "biatch", " cunt", "damn", " ass "]
-                        for w in words:
-                            for l in lines:
-                                if re.search(w, l, re.IGNORECASE):
-                                    self.log_addEntry("What the fuck is this shit? (It isn't professional to swear). File %s contains '%s'" % (f,l), -1)
-                                    profanityCount += 1
+                if not os.path.isfile(f) or os.path.getsize(f) > maxBytes:
+                    continue
+                with open(f, "rb") as fd:
+                    data = fd.read()
+                # Like grep, consider files with NUL bytes near the
+                # beginning to be binary.
+                if b"\0" in data[:8192]:
+                    continue
+
+                # Searching a lowercase copy for each word is much
+                # faster than a case insensitive regular expression.
+                lower = data.lower()
+                hits = []
+                for (index, w) in enumerate(words):
+                    pos = lower.find(w)
+                    while pos != -1:
+                        hits.append((pos, index))
+                        pos = lower.find(w, pos+1)
+                if not hits:
+                    continue
+
+                # Find the lines each word is on (each word is reported
+                # once per line, in the order of profanityWords).
+                found = set()
+                lineNumber = 1
+                last = 0
+                for (pos, index) in sorted(hits):
+                    lineNumber += data.count(b"\n", last, pos)
+                    last = pos
+                    found.add((index, lineNumber, data.rfind(b"\n", 0, pos) + 1))
+
+                for (index, lineNumber, lineStart) in sorted(found):
+                    lineEnd = data.find(b"\n", lineStart)
+                    if lineEnd == -1:
+                        lineEnd = len(data)
+                    l = data[lineStart:lineEnd].decode(errors="replace").rstrip("\r")
+                    self.log_check("profanityCheck", False, "What the fuck is this shit? (It isn't professional to swear). File %s line %d contains '%s'" % (f,lineNumber,l), -1, filename=f, lineNumber=lineNumber)
+                    profanityCount += 1
         if profanityCount > 0:
             self.log_addEntry("This check can produce false positives. If we made a mistake, please let us know about the problem.")
 